@@ -2,90 +2,125 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+import os
+import copy
+import json
+import time
+import concurrent.futures
 import tqdm
 import utils
 import normal
+import architectures
+import storage
+import artifacts
+import attack_metrics
+import checkpoints
 import dataset as DATA 
+from collections import OrderedDict
 from typing import TYPE_CHECKING, Callable, List, Optional, Tuple, Union
-from sklearn import metrics
         
 class MLP_BLACKBOX(nn.Module):
-    def __init__(self, dim_in):
+    def __init__(self, dim_in, hidden=(512, 128, 32)):
         super(MLP_BLACKBOX, self).__init__()
         self.dim_in = dim_in
-        self.fc1 = nn.Linear(self.dim_in, 512)
-        self.fc2 = nn.Linear(512, 128)
-        self.fc3 = nn.Linear(128, 32)
-        self.fc4 = nn.Linear(32, 2)
+        self.num_layers = len(hidden) + 1
+        # fc1 ... fcN, the default sizes keep the layer names of the saved attack models
+        sizes = [self.dim_in] + list(hidden) + [2]
+        for i in range(self.num_layers):
+            setattr(self, 'fc{}'.format(i+1), nn.Linear(sizes[i], sizes[i+1]))
 
     def forward(self, x):
         x = x.view(-1, self.dim_in)
-        x = F.relu(self.fc1(x))
-        x = F.relu(self.fc2(x))
-        x = F.relu(self.fc3(x))
-        x = F.softmax(self.fc4(x), dim=1)
+        for i in range(1, self.num_layers):
+            x = F.relu(getattr(self, 'fc{}'.format(i))(x))
+        x = F.softmax(getattr(self, 'fc{}'.format(self.num_layers))(x), dim=1)
         return x
 
-def train_mia_attack_model(args, epoch, model, attack_train_loader, optimizer, loss_fn, device):
-    model.train()
-    train_loss = 0
-    correct = 0
-
-    for batch_idx, (model_loss_ori, model_trajectory, orginal_labels, predicted_labels, predicted_status, member_status) in enumerate(attack_train_loader):
+def get_attack_tensors(columns, device='cpu'):
+    """Builds the attack input matrix [trajectory, target loss] and the membership labels once, on the attack device"""
+    features = np.concatenate((np.asarray(columns['model_trajectory'], dtype=np.float32),
+                               np.asarray(columns['model_loss_ori'], dtype=np.float32).reshape(-1, 1)), axis=1)
+    # a copy, the column may be a read-only memmap that torch.from_numpy must not wrap
+    member_status = np.array(columns['member_status'], dtype=np.int64)
+    return torch.from_numpy(features).to(device), torch.from_numpy(member_status).to(device)
 
-        input = torch.cat((model_trajectory, model_loss_ori.unsqueeze(1)),1) 
-        input = input.to(device)
+def train_mia_attack_model(args, epoch, model, features, member_status, optimizer, loss_fn, batch_size=128):
+    model.train()
+    train_loss = torch.zeros((), device=features.device)
+    correct = torch.zeros((), dtype=torch.long, device=features.device)
+
+    # shuffling by an on-device permutation of the row indices replaces the DataLoader
+    permutation = torch.randperm(features.shape[0], device=features.device)
+    for start in range(0, features.shape[0], batch_size):
+        batch_idx = permutation[start:start+batch_size]
+        input = features[batch_idx]
+        target = member_status[batch_idx]
         output = model(input)
-        member_status = member_status.to(device)
-        loss = loss_fn(output, member_status)
+        loss = loss_fn(output, target)
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()   
-        train_loss += loss.item()
-        pred = output.max(1, keepdim=True)[1]
-        correct += pred.eq(member_status.view_as(pred)).sum().item()
+        train_loss += loss.detach()
+        correct += (output.argmax(1) == target).sum()
 
-    train_loss /= len(attack_train_loader.dataset)
-    accuracy = 100. * correct / len(attack_train_loader.dataset)
+    train_loss = train_loss.item() / features.shape[0]
+    accuracy = 100. * correct.item() / features.shape[0]
     return train_loss, accuracy/100.
 
-def test_mia_attack_model(args, epoch, model, attack_test_loader, loss_fn, max_auc, max_acc, device):
+def test_mia_attack_model(args, epoch, model, features, member_status, loss_fn, batch_size=128):
     model.eval()
     test_loss = 0
-    correct = 0
-    auc_ground_truth = None
-    auc_pred = None
     with torch.no_grad():
-        for batch_idx, (model_loss_ori, model_trajectory, orginal_labels, predicted_labels, predicted_status, member_status) in enumerate(attack_test_loader):
-
-            input = torch.cat((model_trajectory, model_loss_ori.unsqueeze(1)),1) 
-            input = input.to(device)
-            output = model(input)
-            member_status = member_status.to(device)
-            test_loss += loss_fn(output, member_status).item()
-            pred0, pred1 = output.max(1, keepdim=True)
-            correct += pred1.eq(member_status.view_as(pred1)).sum().item()
-            auc_pred_current = output[:, -1]
-            auc_ground_truth = member_status.cpu().numpy() if batch_idx == 0 else np.concatenate((auc_ground_truth, member_status.cpu().numpy()), axis=0)
-            auc_pred = auc_pred_current.cpu().numpy() if batch_idx == 0 else np.concatenate((auc_pred, auc_pred_current.cpu().numpy()), axis=0)
-
-    test_loss /= len(attack_test_loader.dataset)
-    accuracy = 100. * correct / len(attack_test_loader.dataset)
-
-    fpr, tpr, thresholds = metrics.roc_curve(auc_ground_truth, auc_pred, pos_label=1)
-    auc = metrics.auc(fpr, tpr)
-
-    if auc > max_auc:
-        max_auc = auc
-        save_data = {
-            'fpr': fpr,
-            'tpr': tpr
-        }
-        np.save(f'./outputs/{args.data}_{args.model}_{args.model_distill}_trajectory_auc', save_data)
-    if accuracy > max_acc:
-        max_acc = accuracy
+        output = model(features)
+        for start in range(0, features.shape[0], batch_size):
+            # summed per batch of batch_size, as the loss was reported with the DataLoader
+            test_loss += loss_fn(output[start:start+batch_size], member_status[start:start+batch_size])
+    predictions = output.argmax(1)
+    correct = (predictions == member_status).sum().item()
+
+    test_loss = float(test_loss) / features.shape[0]
+    accuracy = 100. * correct / features.shape[0]
+
+    labels = member_status.cpu().numpy()
+    scores = output[:, -1].cpu().numpy()
+    if args.roc_bins > 0:
+        binned = attack_metrics.BinnedROC(args.roc_bins)
+        binned.update(labels, scores)
+        scores = binned
+    result = attack_metrics.attack_metrics(labels, scores, predictions.cpu().numpy(), get_tpr_fprs(args))
+
+    return test_loss, accuracy/100., result
+
+def get_tpr_fprs(args):
+    return [float(fpr) for fpr in args.tpr_fprs.split(',')]
 
-    return test_loss, accuracy/100., auc, max_auc, max_acc
+def get_attack_config(args):
+    return {'lr': 0.01, 'epochs': 100, 'batch_size': args.attack_batch_size, 'hidden': (512, 128, 32)}
+
+def fit_attack_model(args, config, train_features, train_member_status, test_features, test_member_status, verbose=True):
+    """Trains one MLP_BLACKBOX on the shadow trajectories and scores it on the target trajectories every epoch.
+
+    Returns the model after the last epoch and a summary with the best AUC and accuracy over the epochs, and the
+    ROC curve, balanced accuracy and TPR at each --tpr_fprs of the epoch with the best AUC.
+    """
+    attack_model = MLP_BLACKBOX(dim_in = train_features.shape[1], hidden=config['hidden'])
+    attack_optimizer = torch.optim.SGD(attack_model.parameters(), lr=config['lr'], momentum=0.9, weight_decay=0.0001) 
+    attack_model = attack_model.to(train_features.device)
+    loss_fn = nn.CrossEntropyLoss()
+    result = {'max_auc': 0, 'max_acc': 0}
+
+    for epoch in range(config['epochs']):
+        train_loss, train_prec1 = train_mia_attack_model(args, epoch, attack_model, train_features, train_member_status, attack_optimizer, loss_fn, config['batch_size'])
+        val_loss, val_prec1, val_result = test_mia_attack_model(args, epoch, attack_model, test_features, test_member_status, loss_fn, config['batch_size'])
+        val_auc = val_result['auc']
+        if val_auc > result['max_auc'] or 'fpr' not in result:
+            result.update(val_result, max_auc=val_auc)
+        result['max_acc'] = max(result['max_acc'], val_prec1)
+        if verbose and epoch % 10 == 0:
+            print(('epoch:{} \t train_loss:{:.4f} \t test_loss:{:.4f} \t train_prec1:{:.4f} \t test_prec1:{:.4f} \t val_prec1:{:.4f} \t val_auc:{:.4f}')
+                    .format(epoch, train_loss, val_loss,
+                            train_prec1, val_prec1, val_prec1, val_auc))
+    return attack_model, result
 
 def check_and_transform_label_format(
     labels: np.ndarray, nb_classes: Optional[int] = None, return_one_hot: bool = True
@@ -138,7 +173,10 @@ def to_categorical(labels: Union[np.ndarray, List[float]], nb_classes: Optional[
 
     return categorical
 
-def build_trajectory_membership_dataset(args, ori_model_path, device='cpu'):
+def build_trajectory_membership_dataset(args, device='cpu'):
+    if args.trajectory_workers > 1 and args.trajectory_order != 'epoch':
+        # every batch-order batch is augmented once and scored by all distill seeds, which cannot be split across processes
+        raise ValueError('--trajectory_workers {} needs --trajectory_order epoch'.format(args.trajectory_workers))
 
     if args.model == 'vgg':
         model_name = '{}_vgg16bn'.format(args.data)
@@ -155,78 +193,117 @@ def build_trajectory_membership_dataset(args, ori_model_path, device='cpu'):
     elif args.model == 'rl':
         model_name = '{}_rl'.format(args.data)
         
-    if args.mode == 'shadow':
-        cnn_model, cnn_params = normal.load_model(args, ori_model_path+'/shadow', model_name, epoch=args.epochs)
-    elif args.mode == 'target':
-        cnn_model, cnn_params = normal.load_model(args, ori_model_path+'/target', model_name, epoch=args.epochs)
+    # the loss feature comes from the seed-0 model, with --num_shadows K the shadow trajectories average the
+    # distill runs of all K shadow teachers
+    model_path = artifacts.lookup(args, 'model', args.mode, 0)
+    if model_path is None:
+        raise FileNotFoundError('No {} model trained with these arguments, train it with --action 0 --mode {} first'.format(args.mode, args.mode))
+    cnn_model, cnn_params = normal.load_model(args, model_path, model_name, epoch=args.epochs)
+    ori_model_path = artifacts.get_path(args, 'trajectory', args.mode)
+
+    if args.fold_bn:
+        cnn_model = architectures.export_for_inference(cnn_model)
+    # compiled on its own, the shared per-architecture network is swapped between the distill checkpoints
+    MODEL = utils.get_eval_model(args, cnn_model.to(device))
+
+    if args.trajectory_order == 'epoch':
+        dataset = utils.get_dataset(cnn_params['task'], mode=args.mode, aug=False, batch_size=384, cache=args.tensor_cache)
+
+        if args.mode == 'target':
+            print('load target_dataset ... ')
+            train_loader = dataset.target_train_loader
+            test_loader = dataset.target_test_loader
+
+        elif args.mode == 'shadow':
+            print('load shadow_dataset ... ')
+            train_loader = dataset.shadow_train_loader
+            test_loader = dataset.shadow_test_loader
+    else:
+        dataset = utils.get_dataset(cnn_params['task'], mode=args.mode, aug=True, batch_size=384, cache=args.tensor_cache)
+
+        if args.mode == 'target':
+            print('load target_dataset ... ')
+            train_loader = dataset.aug_target_train_loader
+            test_loader = dataset.aug_target_test_loader
+
+        elif args.mode == 'shadow':
+            print('load shadow_dataset ... ')
+            train_loader = dataset.aug_shadow_train_loader
+            test_loader = dataset.aug_shadow_test_loader
 
-    MODEL = cnn_model.to(device)
-
-    dataset = utils.get_dataset(cnn_params['task'], mode=args.mode, aug=True, batch_size=384)
-
-    if args.mode == 'target':
-        print('load target_dataset ... ')
-        train_loader = dataset.aug_target_train_loader
-        test_loader = dataset.aug_target_test_loader
-
-    elif args.mode == 'shadow':
-        print('load shadow_dataset ... ')
-        train_loader = dataset.aug_shadow_train_loader
-        test_loader = dataset.aug_shadow_test_loader
+    dataset_type = 'trajectory_train_data' if args.mode == 'shadow' else 'trajectory_test_data'
+    utils.create_path(ori_model_path + f'/{model_name}')
 
-    model_top1 = None
-    model_loss = None
-    orginal_labels = None
-    predicted_labels = None
-    predicted_status = None
-    member_status = None
+    outputs = utils.ColumnBuffer(len(train_loader.dataset) + len(test_loader.dataset))
 
     def normalization(data):
         _range = np.max(data) - np.min(data)
         return (data - np.min(data)) / _range
 
     MODEL.eval()
-        
+    trajectory_all = None
+
+    if args.trajectory_order == 'epoch':
+        pools = get_distill_pools(args, device, max_resident=0)
+        member_data, member_target, member_ids = get_split_tensors(train_loader)
+        nonmember_data, nonmember_target, nonmember_ids = get_split_tensors(test_loader)
+        cache_path = ori_model_path + f'/{model_name}/{dataset_type}_trajectory'
+        trajectory_all = get_trajectory_epoch_major(torch.cat((member_data, nonmember_data)), torch.cat((member_target, nonmember_target)), args, cache_path, device, pools)
+        train_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(member_data, member_target, member_ids), batch_size=384)
+        test_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(nonmember_data, nonmember_target, nonmember_ids), batch_size=384)
+    else:
+        pools = get_distill_pools(args, device)
+
+    offset = 0
     for loader_idx, data_loader in enumerate([train_loader, test_loader]):
         top1 = DATA.AverageMeter()
         for data_idx, (data, target, ori_idx) in enumerate(data_loader):
-            batch_trajectory = get_trajectory(data, target, args, ori_model_path, device)
+            if trajectory_all is not None:
+                batch_trajectory = trajectory_all[offset:offset+data.shape[0]]
+            else:
+                batch_trajectory = get_trajectory(data, target, args, ori_model_path, device, pools)
+            offset += data.shape[0]
             data, target = data.to(device), target.to(device)
-            batch_logit_target = MODEL(data)
+            with torch.no_grad():
+                batch_logit_target = MODEL(data)
 
             _, batch_predict_label = batch_logit_target.max(1)
             batch_predicted_label = batch_predict_label.long().cpu().detach().numpy()
             batch_original_label = target.long().cpu().detach().numpy()
-            batch_loss_target = [F.cross_entropy(batch_logit_target_i.unsqueeze(0), target_i.unsqueeze(0)) for (batch_logit_target_i, target_i) in zip(batch_logit_target, target)]
-            batch_loss_target = np.array([batch_loss_target_i.cpu().detach().numpy() for batch_loss_target_i in batch_loss_target])
+            batch_loss_target = utils.get_sample_losses(batch_logit_target, target)
             batch_predicted_status = (torch.argmax(batch_logit_target, dim=1) == target).float().cpu().detach().numpy()
             batch_predicted_status = np.expand_dims(batch_predicted_status, axis=1)
             member = np.repeat(np.array(int(1 - loader_idx)), batch_trajectory.shape[0], 0)
             batch_loss_ori = batch_loss_target
 
-            model_loss_ori               =  batch_loss_ori                  if loader_idx == 0 and data_idx == 0     else np.concatenate((model_loss_ori, batch_loss_ori), axis=0)
-            model_trajectory             =  batch_trajectory                if loader_idx == 0 and data_idx == 0     else np.concatenate((model_trajectory, batch_trajectory), axis=0)
-            original_labels              =  batch_original_label            if loader_idx == 0 and data_idx == 0     else np.concatenate((original_labels, batch_original_label), axis=0)
-            predicted_labels             =  batch_predicted_label           if loader_idx == 0 and data_idx == 0     else np.concatenate((predicted_labels, batch_predicted_label), axis=0)
-            predicted_status             =  batch_predicted_status          if loader_idx == 0 and data_idx == 0     else np.concatenate((predicted_status, batch_predicted_status), axis=0)
-            member_status                =  member                          if loader_idx == 0 and data_idx == 0     else np.concatenate((member_status, member), axis=0)
+            outputs.append(model_loss_ori=batch_loss_ori,
+                           model_trajectory=batch_trajectory,
+                           original_labels=batch_original_label,
+                           predicted_labels=batch_predicted_label,
+                           predicted_status=batch_predicted_status,
+                           member_status=member,
+                           sample_ids=ori_idx.numpy())
             
+    if args.trajectory_order != 'epoch':
+        for pool in pools:
+            pool.report()
     print(f'------------Loading trajectory {args.mode} dataset successfully!---------')
     data = {
-        'model_loss_ori':model_loss_ori, 
-        'model_trajectory':model_trajectory,
-        'original_labels':original_labels,
-        'predicted_labels':predicted_labels,
-        'predicted_status':predicted_status,   
-        'member_status':member_status,
-        'nb_classes':dataset.num_classes
+        'model_loss_ori':outputs['model_loss_ori'], 
+        'model_trajectory':outputs['model_trajectory'],
+        'original_labels':outputs['original_labels'],
+        'predicted_labels':outputs['predicted_labels'],
+        'predicted_status':outputs['predicted_status'],   
+        'member_status':outputs['member_status'],
+        # global ids of the samples in the concatenated train+test base dataset, see dataset.get_split_indices
+        'sample_ids':outputs['sample_ids'],
         }
 
-    dataset_type = 'trajectory_train_data' if args.mode == 'shadow' else 'trajectory_test_data'
-    utils.create_path(ori_model_path + f'/{args.mode}/{model_name}')
-    np.save(ori_model_path + f'/{args.mode}/{model_name}/{dataset_type}', data)
+    storage.save_columns(ori_model_path + f'/{model_name}/{dataset_type}', data, meta={'nb_classes': dataset.num_classes})
+    if args.trajectory_order == 'epoch':
+        clear_trajectory_cache(cache_path, len(pools))
 
-def trajectory_black_box_membership_inference_attack(args, models_path, device='cpu'):
+def trajectory_black_box_membership_inference_attack(args, device='cpu'):
 
     if args.model == 'vgg':
         model_name = '{}_vgg16bn'.format(args.data)
@@ -264,107 +341,369 @@ def trajectory_black_box_membership_inference_attack(args, models_path, device='
 
     orgin_model_name = model_name
 
-    save_path = models_path + '/attack/' + model_name
+    save_path = artifacts.get_path(args, 'attack', seed=args.seed) + '/' + model_name
 
     utils.create_path(save_path)
 
-    best_prec1 = 0.0
-    best_auc = 0.0
-    AttackModelTrainSet = np.load(models_path + f'/shadow/{model_name}/trajectory_train_data.npy', allow_pickle=True).item()
-    AttackModelTestSet = np.load(models_path + f'/target/{model_name}/trajectory_test_data.npy', allow_pickle=True).item()
-
-    train_set = torch.utils.data.TensorDataset(
-            torch.from_numpy(np.array(AttackModelTrainSet['model_loss_ori'], dtype='f')),
-            torch.from_numpy(np.array(AttackModelTrainSet['model_trajectory'], dtype='f')),
-            torch.from_numpy(np.array(check_and_transform_label_format(AttackModelTrainSet['original_labels'], nb_classes=AttackModelTrainSet['nb_classes'], return_one_hot=True))).type(torch.float),
-            torch.from_numpy(np.array(check_and_transform_label_format(AttackModelTrainSet['predicted_labels'], nb_classes=AttackModelTrainSet['nb_classes'], return_one_hot=True))).type(torch.long),
-            torch.from_numpy(np.array(check_and_transform_label_format(AttackModelTrainSet['predicted_status'], nb_classes=2, return_one_hot=True)[:,:2])).type(torch.long),
-            torch.from_numpy(np.array(AttackModelTrainSet['member_status'])).type(torch.long),)
-
-    test_set = torch.utils.data.TensorDataset(
-            torch.from_numpy(np.array(AttackModelTestSet['model_loss_ori'], dtype='f')),
-            torch.from_numpy(np.array(AttackModelTestSet['model_trajectory'], dtype='f')),
-            torch.from_numpy(np.array(check_and_transform_label_format(AttackModelTestSet['original_labels'], nb_classes=AttackModelTestSet['nb_classes'], return_one_hot=True))).type(torch.float),
-            torch.from_numpy(np.array(check_and_transform_label_format(AttackModelTestSet['predicted_labels'], nb_classes=AttackModelTestSet['nb_classes'], return_one_hot=True))).type(torch.long),
-            torch.from_numpy(np.array(check_and_transform_label_format(AttackModelTestSet['predicted_status'], nb_classes=2, return_one_hot=True)[:,:2])).type(torch.long),
-            torch.from_numpy(np.array(AttackModelTestSet['member_status'])).type(torch.long),)
-
-    attack_train_loader = torch.utils.data.DataLoader(train_set, batch_size=128, shuffle=True)
-    attack_test_loader = torch.utils.data.DataLoader(test_set, batch_size=128, shuffle=True)
+    AttackModelTrainSet, _ = storage.load_trajectory_dataset(get_trajectory_dataset_path(args, 'shadow', model_name))
+    AttackModelTestSet, _ = storage.load_trajectory_dataset(get_trajectory_dataset_path(args, 'target', model_name))
+
+    train_features, train_member_status = get_attack_tensors(AttackModelTrainSet, device)
+    test_features, test_member_status = get_attack_tensors(AttackModelTestSet, device)
     
     print(f'-------------------"Loss Trajectory"------------------')
-    attack_model = MLP_BLACKBOX(dim_in = args.epochs_distill + 1)
-    attack_optimizer = torch.optim.SGD(attack_model.parameters(), lr=0.01, momentum=0.9, weight_decay=0.0001) 
-    attack_model = attack_model.to(device)
-    loss_fn = nn.CrossEntropyLoss()
-    max_auc = 0
-    max_acc = 0
-
-    for epoch in range(100):
-        train_loss, train_prec1 = train_mia_attack_model(args, epoch, attack_model, attack_train_loader, attack_optimizer, loss_fn, device)
-        val_loss, val_prec1, val_auc, max_auc, max_acc = test_mia_attack_model(args, epoch, attack_model, attack_test_loader, loss_fn, max_auc, max_acc, device)
-        is_best_prec1 = val_prec1 > best_prec1
-        is_best_auc = val_auc > best_auc
-        if is_best_prec1:
-            best_prec1 = val_prec1
-        if is_best_auc:
-            best_auc = val_auc
-        if epoch % 10 == 0:
-            print(('epoch:{} \t train_loss:{:.4f} \t test_loss:{:.4f} \t train_prec1:{:.4f} \t test_prec1:{:.4f} \t val_prec1:{:.4f} \t val_auc:{:.4f}')
-                    .format(epoch, train_loss, val_loss,
-                            train_prec1, val_prec1, val_prec1, val_auc))
-    print('Max AUC:  ', max_auc)
-    print('Max ACC:  ', max_acc/100)
+    attack_model, result = fit_attack_model(args, get_attack_config(args), train_features, train_member_status, test_features, test_member_status)
+    print('Max AUC:  ', result['max_auc'])
+    print('Max ACC:  ', result['max_acc'])
     torch.save(attack_model.state_dict(), save_path + '/' + 'trajectory' + '.pkl')
+    np.save(artifacts.get_auc_path(args), {'fpr': result['fpr'], 'tpr': result['tpr']})
+    print('Balanced ACC at best AUC:  ', result['balanced_accuracy'])
+    for fpr, tpr in result['tpr_at_fpr'].items():
+        print('TPR at {:g}% FPR:  {:.1%}'.format(fpr*100, tpr))
+
+def withdrawal_membership_inference_attack(args, device='cpu'):
+    """Re-runs the trained trajectory attack on the samples withdrawn from the target training split.
+
+    The withdrawn samples are scored against as many target test samples, once with the loss and distill
+    trajectories of the original target and once with those of the updated target from --is_detected 1, whose
+    distill runs are trained with --mode distill_target_withdrawn. Reports the AUC, TPR at --tpr_fprs and the
+    fraction of withdrawn samples still predicted as members, and saves the member score of every sample by its
+    global id.
+    """
+    model_name = get_model_name(args.data, args.model)
+    model_path_tar = artifacts.lookup(args, 'model', 'target', args.seed)
+    model_path_wd = artifacts.lookup(args, 'withdrawal', 'target_withdrawn', args.seed)
+    attack_path = artifacts.lookup(args, 'attack', seed=args.seed)
+    if model_path_tar is None or model_path_wd is None:
+        raise FileNotFoundError('No withdrawn target trained with these arguments, run --action 0 --mode target --is_detected 1 first')
+    if attack_path is None:
+        raise FileNotFoundError('No attack model trained with these arguments, run --mia_type black-box first')
+    for mode in ['target', 'target_withdrawn']:
+        if any(artifacts.lookup(args, 'distill', 'distill_' + mode, s) is None for s in range(args.num_shadows)):
+            raise FileNotFoundError('No distill runs of the {} trained with these arguments, run --action 0 --mode distill_{} first'.format(mode, mode))
+
+    withdrawn = np.load(model_path_wd + f'/{model_name}/withdrawn_indices.npy')
+    _, cnn_params = normal.load_model(args, model_path_tar, model_name, epoch=args.epochs)
+    dataset = utils.get_dataset(cnn_params['task'], mode='target', aug=False, batch_size=384, cache=args.tensor_cache)
+    member_data, member_target, member_ids = get_split_tensors(dataset.target_train_loader)
+    nonmember_data, nonmember_target, nonmember_ids = get_split_tensors(dataset.target_test_loader)
+    nonmembers = np.random.RandomState(args.seed).permutation(len(nonmember_target))[:len(withdrawn)]
+    data = torch.cat((member_data[withdrawn], nonmember_data[nonmembers]))
+    target = torch.cat((member_target[withdrawn], nonmember_target[nonmembers]))
+    member_status = np.r_[np.ones(len(withdrawn), dtype=np.int64), np.zeros(len(nonmembers), dtype=np.int64)]
+    scores = {'sample_ids': torch.cat((member_ids[withdrawn], nonmember_ids[nonmembers])).numpy(), 'member_status': member_status}
+    print('Scoring {} withdrawn and {} non-member samples'.format(len(withdrawn), len(nonmembers)))
+
+    attack_state = torch.load(attack_path + f'/{model_name}/trajectory.pkl', map_location='cpu')
+    attack_model = MLP_BLACKBOX(dim_in=attack_state['fc1.weight'].shape[1])
+    attack_model.load_state_dict(attack_state)
+    attack_model = attack_model.to(device)
+    attack_model.eval()
+
+    fprs = get_tpr_fprs(args)
+    results = {}
+    for name, mode, model_path, epoch in [('original', 'target', model_path_tar, args.epochs), ('withdrawn', 'target_withdrawn', model_path_wd, -1)]:
+        pools = get_distill_pools(args, device, mode=mode)
+        trajectory = np.concatenate([get_trajectory(data[start:start+384], target[start:start+384], args, None, device, pools)
+                                     for start in range(0, len(target), 384)])
+        cnn_model, _ = normal.load_model(args, model_path, model_name, epoch=epoch)
+        if args.fold_bn:
+            cnn_model = architectures.export_for_inference(cnn_model)
+        MODEL = utils.get_eval_model(args, cnn_model.to(device))
+        MODEL.eval()
+        losses = []
+        with torch.no_grad():
+            for start in range(0, len(target), 384):
+                batch_data = utils.to_model_format(MODEL, data[start:start+384].to(device))
+                losses.append(utils.get_sample_losses(MODEL(batch_data), target[start:start+384].to(device)))
+        features, _ = get_attack_tensors({'model_trajectory': trajectory, 'model_loss_ori': np.concatenate(losses), 'member_status': member_status}, device)
+        with torch.no_grad():
+            output = attack_model(features)
+        predictions = output.argmax(1).cpu().numpy()
+        scores[name + '_score'] = output[:, -1].cpu().numpy()
+        result = attack_metrics.attack_metrics(member_status, scores[name + '_score'], predictions, fprs)
+        results[name] = {'auc': result['auc'], 'balanced_accuracy': result['balanced_accuracy'], 'tpr_at_fpr': result['tpr_at_fpr'],
+                         'withdrawn_predicted_members': float(predictions[member_status == 1].mean())}
+
+    print('{:>10} {:>8} {:>8} {:>10}'.format('target', 'AUC', 'BalACC', 'members')
+          + ''.join(' {:>14}'.format('TPR@{:g}%FPR'.format(fpr*100)) for fpr in fprs))
+    for name, result in results.items():
+        print('{:>10} {:>8.4f} {:>8.4f} {:>10.1%}'.format(name, result['auc'], result['balanced_accuracy'], result['withdrawn_predicted_members'])
+              + ''.join(' {:>14.1%}'.format(result['tpr_at_fpr'][fpr]) for fpr in fprs))
+    with open(model_path_wd + f'/{model_name}/withdrawal_attack.json', 'w') as f:
+        json.dump({name: dict(result, tpr_at_fpr={str(fpr): tpr for fpr, tpr in result['tpr_at_fpr'].items()}) for name, result in results.items()}, f, indent=2)
+    storage.save_columns(model_path_wd + f'/{model_name}/withdrawal_scores', scores)
+
+def get_sweep_configs(args):
+    configs = []
+    for lr in args.sweep_lr.split(','):
+        for epochs in args.sweep_epochs.split(','):
+            for batch_size in args.sweep_batch_size.split(','):
+                for hidden in args.sweep_hidden.split(','):
+                    configs.append({'lr': float(lr), 'epochs': int(epochs), 'batch_size': int(batch_size),
+                                    'hidden': tuple(int(width) for width in hidden.split('-'))})
+    return configs
+
+def sweep_worker(args, config, train_tensors, test_tensors, num_threads):
+    torch.set_num_threads(num_threads)
+    utils.set_random_seeds(args.seed)
+    start_time = time.time()
+    _, result = fit_attack_model(args, config, *train_tensors, *test_tensors, verbose=False)
+    return {'max_auc': result['max_auc'], 'max_acc': result['max_acc'], 'balanced_accuracy': result['balanced_accuracy'],
+            'tpr_at_fpr': result['tpr_at_fpr'], 'seconds': time.time() - start_time}
+
+def attack_hyperparameter_sweep(args, device='cpu'):
+    """Trains one attack model per combination of --sweep_lr/--sweep_epochs/--sweep_batch_size/--sweep_hidden.
+
+    The shadow and target trajectory tensors are loaded once and placed in shared memory, and the configurations
+    are trained concurrently by --sweep_workers processes. Every configuration starts from the same --seed.
+    """
+    model_name = get_model_name(args.data, args.model)
+    AttackModelTrainSet, _ = storage.load_trajectory_dataset(get_trajectory_dataset_path(args, 'shadow', model_name))
+    AttackModelTestSet, _ = storage.load_trajectory_dataset(get_trajectory_dataset_path(args, 'target', model_name))
+    train_tensors = get_attack_tensors(AttackModelTrainSet)
+    test_tensors = get_attack_tensors(AttackModelTestSet)
+    configs = get_sweep_configs(args)
+    print('Sweeping {} attack configurations with {} workers'.format(len(configs), args.sweep_workers))
+
+    if args.sweep_workers > 1:
+        for tensor in train_tensors + test_tensors:
+            tensor.share_memory_()
+        num_threads = max(1, torch.get_num_threads() // args.sweep_workers)
+        context = torch.multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.sweep_workers, mp_context=context) as executor:
+            futures = [executor.submit(sweep_worker, args, config, train_tensors, test_tensors, num_threads) for config in configs]
+            results = [future.result() for future in futures]
+    else:
+        train_tensors = tuple(tensor.to(device) for tensor in train_tensors)
+        test_tensors = tuple(tensor.to(device) for tensor in test_tensors)
+        results = [sweep_worker(args, config, train_tensors, test_tensors, torch.get_num_threads()) for config in configs]
+
+    fprs = get_tpr_fprs(args)
+    print('{:>8} {:>7} {:>7} {:>16} {:>8} {:>8} {:>8}'.format('lr', 'epochs', 'batch', 'hidden', 'AUC', 'ACC', 'BalACC')
+          + ''.join(' {:>14}'.format('TPR@{:g}%FPR'.format(fpr*100)) for fpr in fprs) + ' {:>9}'.format('seconds'))
+    for config, result in zip(configs, results):
+        print('{:>8} {:>7} {:>7} {:>16} {:>8.4f} {:>8.4f} {:>8.4f}'.format(config['lr'], config['epochs'], config['batch_size'],
+              '-'.join(str(width) for width in config['hidden']), result['max_auc'], result['max_acc'], result['balanced_accuracy'])
+              + ''.join(' {:>14.1%}'.format(result['tpr_at_fpr'][fpr]) for fpr in fprs) + ' {:>9.1f}'.format(result['seconds']))
+
+    save_path = artifacts.get_path(args, 'attack', seed=args.seed) + '/' + model_name
+    utils.create_path(save_path)
+    with open(save_path + '/sweep.json', 'w') as f:
+        json.dump([dict(config, **result) for config, result in zip(configs, results)], f, indent=2)
+    return results
+
+class DistillCheckpointPool(object):
+    """Keeps the distilled snapshots of one run in memory so that every checkpoint is read from disk once per build"""
+    def __init__(self, model_path, model_name, args, device='cpu', max_resident=None, seed=0):
+        self.model_path = model_path
+        self.seed = seed
+        self.model_name = model_name
+        self.args = args
+        self.device = device
+        # snapshots beyond the bound are streamed from disk on every request instead of evicting resident ones,
+        # which keeps the hit rate at max_resident/epochs_distill for the cyclic access pattern of get_trajectory
+        self.max_resident = args.epochs_distill if max_resident is None else max_resident
+        self.models = OrderedDict()
+        self.model_params = None
+        # network built once and pointed at each epoch of a weight bank, see checkpoints.WeightBank
+        self.template = None
+        self.num_loads = 0
+        self.load_time = 0.0
+        self.compute_time = 0.0
+
+    def get(self, epoch):
+        model = self.models[epoch] if epoch in self.models else self.load(epoch)
+        if self.args.compile_inference:
+            return utils.get_compiled_model(model, self.model_params, self.device)
+        return model
+
+    def load(self, epoch):
+        start_time = time.time()
+        bank = checkpoints.get_bank(self.model_path + '/' + self.model_name)
+        if bank is not None and epoch in bank:
+            if self.template is None:
+                self.template, self.model_params = normal.load_model(self.args, self.model_path, self.model_name, epoch=epoch)
+                self.template = self.template.to(self.device)
+            # the template is pointed at each epoch in turn, a resident snapshot that is not folded needs a network of its own
+            keep = len(self.models) < self.max_resident and not self.args.fold_bn
+            model = bank.load_into(copy.deepcopy(self.template) if keep else self.template, epoch)
+        else:
+            model, self.model_params = normal.load_model(self.args, self.model_path, self.model_name, epoch=epoch)
+        if self.args.fold_bn:
+            model = architectures.export_for_inference(model)
+        model = model.to(self.device)
+        model.eval()
+        self.load_time += time.time() - start_time
+        self.num_loads += 1
+
+        if len(self.models) < self.max_resident:
+            self.models[epoch] = model
+        return model
+
+    def report(self):
+        print('Trajectory pool {}: {} checkpoint loads ({} resident), load {:.2f}s, compute {:.2f}s'.format(
+            self.model_path, self.num_loads, len(self.models), self.load_time, self.compute_time))
+
+def get_model_name(data, model):
+    if model == 'vgg':
+        model_name = '{}_vgg16bn'.format(data)
+    elif model == 'mobilenet':
+        model_name = '{}_mobilenet'.format(data)
+    elif model == 'resnet':
+        model_name = '{}_resnet56'.format(data)
+    elif model == 'wideresnet':
+        model_name = '{}_wideresnet'.format(data)
+    elif model == 'lenet':
+        model_name = '{}_lenet'.format(data)
+    elif model == 'rnn':
+        model_name = '{}_rnn'.format(data)
+    elif model == 'rl':
+        model_name = '{}_rl'.format(data)
+    return model_name
+
+def get_trajectory_dataset_path(args, mode, model_name):
+    dataset_type = 'trajectory_train_data' if mode == 'shadow' else 'trajectory_test_data'
+    trajectory_path = artifacts.lookup(args, 'trajectory', mode)
+    if trajectory_path is None:
+        raise FileNotFoundError('No {} trajectory dataset built with these arguments, run --mia_type build-dataset --mode {} first'.format(mode, mode))
+    return trajectory_path + f'/{model_name}/{dataset_type}'
+
+def get_distill_model_name(args):
+    return get_model_name(args.data, args.model_distill)
+
+def get_distill_pools(args, device='cpu', max_resident=None, mode=None):
+    model_name = get_distill_model_name(args)
+    if max_resident is None:
+        max_resident = args.max_resident_models or None
+    if mode is None:
+        mode = args.mode
+    pools = []
+    for s in range(args.num_shadows):
+        model_path_current = artifacts.get_path(args, 'distill', 'distill_' + mode, s)
+        pools.append(DistillCheckpointPool(model_path_current, model_name, args, device, max_resident, seed=s))
+    return pools
+
+def aggregate_trajectories(trajectories, args):
+    # one (N, epochs_distill) matrix per distill seed, combined into the attack features
+    if args.trajectory_agg == 'stack':
+        return np.concatenate(trajectories, axis=1)
+    trajectory = trajectories[0]
+    for trajectory_current in trajectories[1:]:
+        trajectory = trajectory + trajectory_current
+    if args.trajectory_agg == 'mean':
+        trajectory = trajectory / len(trajectories)
+    return trajectory
 
-    data_auc = np.load(f'./outputs/{args.data}_{args.model}_{args.model_distill}_trajectory_auc.npy', allow_pickle=True).item()
-    for i in range(len(data_auc['fpr'])):
-        if data_auc['fpr'][i] > 0.001:
-            print('TPR at 0.1% FPR:  {:.1%}'.format(data_auc['tpr'][i-1]))
-            break
-
-def get_trajectory(data, target, args, model_path, device='cpu'):
+def get_trajectory(data, target, args, model_path, device='cpu', pools=None):
+    if pools is None:
+        pools = get_distill_pools(args, device)
 
-    if args.model_distill == 'vgg':
-        model_name = '{}_vgg16bn'.format(args.data)
-    elif args.model_distill == 'mobilenet':
-        model_name = '{}_mobilenet'.format(args.data)
-    elif args.model_distill == 'resnet':
-        model_name = '{}_resnet56'.format(args.data)
-    elif args.model_distill == 'wideresnet':
-        model_name = '{}_wideresnet'.format(args.data)
-    elif args.model_distill == 'lenet':
-        model_name = '{}_lenet'.format(args.data)
-    elif args.model_distill == 'rnn':
-        model_name = '{}_rnn'.format(args.data)
-    elif args.model_distill == 'rl':
-        model_name = '{}_rl'.format(args.data)
-        
-    trajectory = None
-    predicted_label = np.array([-1]).repeat(data.shape[0],0).reshape(data.shape[0],1)
+    trajectories = []
+    data = data.to(device)
+    target = target.to(device)
 
-    for s in range(1):
-        trajectory_current = None
-        model_path_current = 'networks/{}'.format(s)
+    for pool in pools:
+        trajectory_current = np.zeros((data.shape[0], args.epochs_distill), dtype=np.float32)
         for i in range(1, args.epochs_distill+1):
-            if args.mode == 'shadow':
-                cnn_model_target, cnn_params_target = normal.load_model(args, model_path_current+'/distill_shadow', model_name, epoch=i)
-            elif args.mode == 'target':
-                cnn_model_target, cnn_params_target = normal.load_model(args, model_path_current+'/distill_target', model_name, epoch=i)
-            MODEL_target = cnn_model_target.to(device)
-            data = data.to(device)
-            target = target.to(device)
-            logit_target = MODEL_target(data)
-            loss = [F.cross_entropy(logit_target_i.unsqueeze(0), target_i.unsqueeze(0)) for (logit_target_i, target_i) in zip(logit_target, target)]
-            loss = np.array([loss_i.detach().cpu().numpy() for loss_i in loss]).reshape(-1, 1)
-            trajectory_current = loss if i == 1 else np.concatenate((trajectory_current, loss), 1)
-        trajectory = trajectory_current if s == 0 else trajectory + trajectory_current
-
+            MODEL_target = pool.get(i)
+            start_time = time.time()
+            with torch.no_grad():
+                logit_target = MODEL_target(data)
+                trajectory_current[:, i-1] = utils.get_sample_losses(logit_target, target)
+            pool.compute_time += time.time() - start_time
+        trajectories.append(trajectory_current)
+
+    return aggregate_trajectories(trajectories, args)
+
+def get_split_tensors(loader):
+    # a fixed, non-shuffled copy of the split so that every checkpoint scores the samples in the same row order
+    data_all = []
+    target_all = []
+    ids_all = []
+    ordered_loader = torch.utils.data.DataLoader(loader.dataset, batch_size=loader.batch_size, shuffle=False, num_workers=loader.num_workers)
+    for data, target, ori_idx in ordered_loader:
+        data_all.append(data)
+        target_all.append(target)
+        ids_all.append(ori_idx)
+    return torch.cat(data_all), torch.cat(target_all), torch.cat(ids_all)
+
+def get_trajectory_epoch_major(data, target, args, cache_path, device='cpu', pools=None, batch_size=384):
+    """Fills the (N, epochs_distill) loss matrix of every distill seed one checkpoint column at a time.
+
+    Columns are written into a memory-mapped float32 matrix next to the trajectory dataset and a per-column
+    marker is saved after each one, so an interrupted build resumes at the first unfinished distill epoch.
+    With several distill seeds and --trajectory_workers > 1 the seeds are extracted in parallel processes.
+    """
+    if pools is None:
+        pools = get_distill_pools(args, device, max_resident=0)
+
+    num_workers = min(args.trajectory_workers, len(pools))
+    if num_workers > 1:
+        data.share_memory_()
+        target.share_memory_()
+        num_threads = max(1, torch.get_num_threads() // num_workers)
+        context = torch.multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+            futures = [executor.submit(seed_trajectory_worker, data, target, args, cache_path, get_worker_device(device, pool.seed), pool.seed, num_threads, batch_size) for pool in pools]
+            trajectories = [future.result() for future in futures]
+    else:
+        trajectories = [get_seed_trajectory_epoch_major(data, target, args, cache_path, pool, device, batch_size) for pool in pools]
+        for pool in pools:
+            pool.report()
+
+    return aggregate_trajectories(trajectories, args)
+
+def get_worker_device(device, seed):
+    if device == 'cuda' and torch.cuda.device_count() > 1:
+        return 'cuda:{}'.format(seed % torch.cuda.device_count())
+    return device
+
+def seed_trajectory_worker(data, target, args, cache_path, device, seed, num_threads, batch_size=384):
+    torch.set_num_threads(num_threads)
+    pool = DistillCheckpointPool(artifacts.get_path(args, 'distill', 'distill_' + args.mode, seed), get_distill_model_name(args), args, device, max_resident=0, seed=seed)
+    trajectory = get_seed_trajectory_epoch_major(data, target, args, cache_path, pool, device, batch_size)
+    pool.report()
     return trajectory
 
+def get_seed_trajectory_epoch_major(data, target, args, cache_path, pool, device='cpu', batch_size=384):
+    num_samples = data.shape[0]
+    shape = (num_samples, args.epochs_distill)
+    matrix_path = '{}_{}.npy'.format(cache_path, pool.seed)
+    done_path = '{}_{}_done.npy'.format(cache_path, pool.seed)
 
-
-
-
-
-        
\ No newline at end of file
+    trajectory = None
+    if os.path.exists(matrix_path) and os.path.exists(done_path):
+        trajectory = np.lib.format.open_memmap(matrix_path, mode='r+')
+        done = np.load(done_path)
+        if trajectory.shape != shape or done.shape != (args.epochs_distill,):
+            trajectory = None
+        else:
+            print('Resuming trajectory {} with {}/{} epochs done'.format(matrix_path, int(done.sum()), args.epochs_distill))
+    if trajectory is None:
+        trajectory = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=shape)
+        done = np.zeros(args.epochs_distill, dtype=bool)
+
+    for i in range(1, args.epochs_distill+1):
+        if done[i-1]:
+            continue
+        MODEL_target = pool.get(i)
+        start_time = time.time()
+        with torch.no_grad():
+            for start in range(0, num_samples, batch_size):
+                batch_data = data[start:start+batch_size].to(device)
+                batch_target = target[start:start+batch_size].to(device)
+                logit_target = MODEL_target(batch_data)
+                trajectory[start:start+batch_size, i-1] = utils.get_sample_losses(logit_target, batch_target)
+        pool.compute_time += time.time() - start_time
+        trajectory.flush()
+        done[i-1] = True
+        np.save(done_path, done)
+
+    return np.array(trajectory)
+
+def clear_trajectory_cache(cache_path, num_seeds):
+    for s in range(num_seeds):
+        for path in ['{}_{}.npy'.format(cache_path, s), '{}_{}_done.npy'.format(cache_path, s)]:
+            if os.path.exists(path):
+                os.remove(path)
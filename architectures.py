@@ -1,9 +1,11 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import copy
 import math
 import numpy as np
 import utils
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 class Bottleneck(nn.Module):
     expansion = 4
@@ -193,10 +195,9 @@ class RNN(nn.Module):
     def __init__(self, args, params):
         super(RNN, self).__init__()
 
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-
         # 使用 params 中的参数来配置模型
         self.num_classes = int(params['num_classes'])
+        self.input_size = int(params['input_size'])
         self.block_type = params['block_type']
         self.train_func = utils.cnn_train
         
@@ -205,17 +206,18 @@ class RNN(nn.Module):
         self.num_layers = 2
 
         # 定义卷积层
-        self.conv1 = nn.Conv2d(in_channels=3, out_channels=16, kernel_size=3, stride=1, padding=1).to(self.device)
-        self.pool = nn.MaxPool2d(2, 2).to(self.device)
+        self.conv1 = nn.Conv2d(in_channels=3, out_channels=16, kernel_size=3, stride=1, padding=1)
+        self.pool = nn.MaxPool2d(2, 2)
 
-        # 先定义 RNN，但不硬编码 input_size
-        self.rnn = None
-        self.fc = nn.Linear(self.hidden_size, self.num_classes).to(self.device)
+        # 构造时根据输入尺寸确定 RNN 的输入大小，使未训练的模型也保存 RNN 的权重
+        self.seq_len, self.rnn_input_size = self._get_rnn_input_size(self.input_size)
+        self.rnn = nn.RNN(input_size=self.rnn_input_size, hidden_size=self.hidden_size, num_layers=self.num_layers, batch_first=True)
+        self.fc = nn.Linear(self.hidden_size, self.num_classes)
 
     def _get_rnn_input_size(self, input_size):
-        """动态计算卷积层输出的尺寸，用于 RNN 输入"""
+        """计算卷积层输出的尺寸，用于 RNN 输入"""
         with torch.no_grad():
-            x = torch.zeros(1, 3, input_size, input_size).to(self.device)  # 假设输入图像是 3 通道
+            x = torch.zeros(1, 3, input_size, input_size)  # 假设输入图像是 3 通道
             x = self.pool(torch.relu(self.conv1(x)))  # 通过卷积和池化层
             batch_size, channels, height, width = x.size()
             seq_len = height
@@ -223,24 +225,11 @@ class RNN(nn.Module):
             return seq_len, input_size
 
     def forward(self, x):
-        # 确保输入数据与模型参数在同一设备上
-        x = x.to(self.device)  # 将输入数据移动到设备上
-        
-        # 获取卷积输出的尺寸，计算 RNN 的输入大小
-        seq_len, input_size = self._get_rnn_input_size(x.size(2))  # x 的形状是 [batch_size, channels, height, width]
-        
-        # 定义 RNN 层
-        if self.rnn is None:  # 只初始化一次 RNN
-            self.rnn = nn.RNN(input_size=input_size, hidden_size=self.hidden_size, num_layers=self.num_layers, batch_first=True).to(self.device)
-        
         # 通过卷积层提取特征
         x = self.pool(torch.relu(self.conv1(x)))  # 输出形状: [batch_size, 16, H, W]
         
-        # 动态计算卷积输出的尺寸
-        batch_size, channels, height, width = x.size()
-        
         # 将 x 变形为适合 RNN 的输入: [batch_size, seq_len, input_size]
-        x = x.view(batch_size, seq_len, input_size)
+        x = x.view(x.size(0), self.seq_len, self.rnn_input_size)
 
         # 传递给 RNN
         out, _ = self.rnn(x)  # out 的形状: [batch_size, seq_len, hidden_size]
@@ -581,5 +570,44 @@ class MobileNet(nn.Module):
         fwd = self.end_layers(fwd)
         return fwd
 
+def fold_sequential(sequential):
+    layers = []
+    for layer in sequential:
+        if isinstance(layer, nn.Dropout):
+            continue
+        if isinstance(layer, nn.BatchNorm2d) and len(layers) > 0 and isinstance(layers[-1], nn.Conv2d):
+            layers[-1] = fuse_conv_bn_eval(layers[-1], layer)
+            continue
+        layers.append(layer)
+    if len(layers) == 0:
+        return nn.Identity()
+    return nn.Sequential(*layers)
+
+def fold_module(module):
+    for name, child in module.named_children():
+        fold_module(child)
+        if isinstance(child, nn.Sequential):
+            setattr(module, name, fold_sequential(child))
+
+def export_for_inference(model):
+    """Returns an eval()-only copy of a network for scoring.
+
+    Every BatchNorm2d that directly follows a Conv2d inside a Sequential (ResNet56 BasicBlock, the middle of
+    wide_basic, VGG ConvBlock, MobileNet Block) is folded into the convolution's weights and bias, dropout is
+    removed and the empty Sequential() shortcuts become identities. The copy computes the same function as the
+    network in eval() mode and must not be trained.
+    """
+    model = copy.deepcopy(model)
+    model.eval()
+    fold_module(model)
+    model.folded = True
+    return model
+
+class ShardEnsemble(nn.Module):
+    """SISA target, one network per shard of the target training split whose logits are averaged"""
+    def __init__(self, shards):
+        super(ShardEnsemble, self).__init__()
+        self.shards = nn.ModuleList(shards)
 
-
+    def forward(self, x):
+        return torch.stack([shard(x) for shard in self.shards]).mean(0)
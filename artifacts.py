@@ -0,0 +1,88 @@
+import os
+import json
+import hashlib
+
+STORE_ROOT = 'networks/store'
+
+# arguments that change the content of each kind of artifact, everything else is read from the upstream artifacts
+ARTIFACT_ARGS = {
+    'model': ['data', 'model', 'epochs', 'port_num', 'precision', 'num_shards', 'num_slices'],
+    'distill': ['data', 'model', 'model_distill', 'epochs', 'port_num', 'teacher_cache', 'precision', 'checkpoint_store', 'keyframe_every'],
+    'trajectory': ['data', 'model', 'model_distill', 'epochs_distill', 'num_shadows', 'trajectory_order', 'trajectory_agg'],
+    'attack': ['data', 'model', 'model_distill', 'attack_batch_size'],
+    'withdrawal': ['data', 'model', 'ratio', 'withdraw_epochs', 'withdraw_lr', 'precision'],
+}
+
+def get_kind(mode):
+    return 'distill' if 'distill' in mode else 'model'
+
+def get_teacher(args, mode, seed):
+    """(kind, mode, seed) of the artifact distill run `seed` of `mode` learns from.
+
+    With --num_shadows K every shadow seed has a teacher of its own, while the target and the withdrawn target
+    are trained once and all K of their distill runs learn from seed 0.
+    """
+    if mode == 'distill_target_withdrawn':
+        return 'withdrawal', 'target_withdrawn', 0
+    return 'model', mode.split('_')[-1], seed if args.num_shadows > 1 and mode == 'distill_shadow' else 0
+
+def get_upstream(args, kind, mode, seed):
+    if kind == 'distill':
+        return [get_key(args, *get_teacher(args, mode, seed))]
+    elif kind == 'trajectory':
+        return [get_key(args, 'model', mode, 0)] + [get_key(args, 'distill', 'distill_' + mode, s) for s in range(args.num_shadows)]
+    elif kind == 'attack':
+        return [get_key(args, 'trajectory', 'shadow'), get_key(args, 'trajectory', 'target')]
+    elif kind == 'withdrawal':
+        # fine-tuned from the trained target of the same seed
+        return [get_key(args, 'model', 'target', seed)]
+    return []
+
+def get_config(args, kind, mode=None, seed=0):
+    config = {name: getattr(args, name) for name in ARTIFACT_ARGS[kind]}
+    config['kind'] = kind
+    config['mode'] = mode
+    config['seed'] = seed
+    config['upstream'] = get_upstream(args, kind, mode, seed)
+    return config
+
+def get_key(args, kind, mode=None, seed=0):
+    config = get_config(args, kind, mode, seed)
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+def get_path(args, kind, mode=None, seed=0):
+    """Directory that holds an artifact, it takes the place of the networks/{seed}/{mode} folders.
+
+    With --artifact_store the directory is networks/store/{kind}/{key}, where the key hashes the arguments
+    in ARTIFACT_ARGS together with the keys of the upstream artifacts, so runs with different settings never
+    share a folder and a changed teacher invalidates everything built on top of it.
+    """
+    if not args.artifact_store:
+        if kind in ['model', 'distill', 'withdrawal']:
+            return 'networks/{}/{}'.format(seed, mode)
+        elif kind == 'trajectory':
+            return 'networks/0/{}'.format(mode)
+        elif kind == 'attack':
+            return 'networks/{}/attack'.format(seed)
+    return '{}/{}/{}'.format(STORE_ROOT, kind, get_key(args, kind, mode, seed))
+
+def lookup(args, kind, mode=None, seed=0):
+    """Returns the directory of a finished artifact, or None if it was not built with these arguments"""
+    path = get_path(args, kind, mode, seed)
+    if not args.artifact_store:
+        # the legacy folders do not record what they were built from
+        return path if os.path.exists(path) else None
+    return path if os.path.exists(path + '/artifact.json') else None
+
+def commit(args, kind, mode=None, seed=0):
+    # written last, so an interrupted stage is rebuilt instead of being reused
+    path = get_path(args, kind, mode, seed)
+    if args.artifact_store:
+        with open(path + '/artifact.json', 'w') as f:
+            json.dump(get_config(args, kind, mode, seed), f, indent=2)
+    return path
+
+def get_auc_path(args):
+    if not args.artifact_store:
+        return './outputs/{}_{}_{}_trajectory_auc.npy'.format(args.data, args.model, args.model_distill)
+    return get_path(args, 'attack', seed=args.seed) + '/trajectory_auc.npy'
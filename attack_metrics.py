@@ -0,0 +1,85 @@
+import numpy as np
+
+def roc_curve(labels, scores):
+    """ROC curve of membership scores, a higher score meaning member.
+
+    Scores are sorted once and the true/false positive counts are cumulative sums over the sorted labels, with one
+    point per distinct score. Returns fpr, tpr and thresholds starting at (0, 0).
+    """
+    labels = np.asarray(labels).ravel().astype(bool)
+    scores = np.asarray(scores, dtype=np.float64).ravel()
+    order = np.argsort(-scores, kind='stable')
+    scores = scores[order]
+    labels = labels[order]
+
+    # the last position of every run of equal scores
+    distinct = np.r_[np.flatnonzero(np.diff(scores)), scores.size - 1]
+    true_positives = np.cumsum(labels)[distinct]
+    false_positives = distinct + 1 - true_positives
+    return counts_to_roc(true_positives, false_positives, scores[distinct])
+
+def counts_to_roc(true_positives, false_positives, thresholds):
+    true_positives = np.r_[0, true_positives]
+    false_positives = np.r_[0, false_positives]
+    thresholds = np.r_[np.inf, thresholds]
+    fpr = false_positives / max(false_positives[-1], 1)
+    tpr = true_positives / max(true_positives[-1], 1)
+    return fpr, tpr, thresholds
+
+def auc(fpr, tpr):
+    return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+def tpr_at_fpr(fpr, tpr, max_fprs):
+    """Highest TPR reached with an FPR of at most each value of `max_fprs`"""
+    idx = np.searchsorted(fpr, np.asarray(max_fprs, dtype=np.float64), side='right') - 1
+    return tpr[np.maximum(idx, 0)]
+
+def balanced_accuracy(labels, predictions):
+    labels = np.asarray(labels).ravel().astype(bool)
+    predictions = np.asarray(predictions).ravel().astype(bool)
+    true_positive_rate = np.mean(predictions[labels]) if labels.any() else 0.0
+    true_negative_rate = np.mean(~predictions[~labels]) if (~labels).any() else 0.0
+    return float((true_positive_rate + true_negative_rate) / 2)
+
+class BinnedROC(object):
+    """Streaming ROC over scores in [low, high], accumulated as member/non-member histograms.
+
+    Memory is two arrays of `num_bins` counts however many samples are added, and the curve has one point per
+    non-empty bin, so the AUC and TPR at low FPR are exact up to the bin width.
+    """
+    def __init__(self, num_bins=10000, low=0.0, high=1.0):
+        self.num_bins = num_bins
+        self.low = low
+        self.high = high
+        self.positives = np.zeros(num_bins, dtype=np.int64)
+        self.negatives = np.zeros(num_bins, dtype=np.int64)
+
+    def update(self, labels, scores):
+        labels = np.asarray(labels).ravel().astype(bool)
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        bins = np.clip(((scores - self.low) / (self.high - self.low) * self.num_bins).astype(np.int64), 0, self.num_bins - 1)
+        self.positives += np.bincount(bins[labels], minlength=self.num_bins)
+        self.negatives += np.bincount(bins[~labels], minlength=self.num_bins)
+
+    def roc_curve(self):
+        # from the highest bin down, skipping empty bins
+        positives = self.positives[::-1]
+        negatives = self.negatives[::-1]
+        filled = np.flatnonzero(positives + negatives)
+        edges = self.low + (self.high - self.low) * np.arange(self.num_bins, 0, -1) / self.num_bins
+        return counts_to_roc(np.cumsum(positives)[filled], np.cumsum(negatives)[filled], edges[filled] - (self.high - self.low) / self.num_bins)
+
+def attack_metrics(labels, scores, predictions=None, max_fprs=(0.001,)):
+    """AUC, balanced accuracy and TPR at each of `max_fprs` of one set of membership scores, all in memory.
+
+    `scores` may also be a BinnedROC that already holds the scores, then `labels` is ignored for the curve.
+    """
+    if isinstance(scores, BinnedROC):
+        fpr, tpr, _ = scores.roc_curve()
+    else:
+        fpr, tpr, _ = roc_curve(labels, scores)
+    result = {'auc': auc(fpr, tpr), 'fpr': fpr, 'tpr': tpr,
+              'tpr_at_fpr': dict(zip(max_fprs, tpr_at_fpr(fpr, tpr, max_fprs).tolist()))}
+    if predictions is not None:
+        result['balanced_accuracy'] = balanced_accuracy(labels, predictions)
+    return result
@@ -0,0 +1,296 @@
+import os
+import time
+import copy
+import argparse
+import tempfile
+import torch
+import torch.nn.functional as F
+import numpy as np
+import utils
+import normal
+import checkpoints
+import architectures
+import main
+
+def time_function(func, repeats):
+    func()
+    start_time = time.time()
+    for _ in range(repeats):
+        func()
+    return (time.time() - start_time) / repeats
+
+def benchmark_sample_losses(args, device='cpu'):
+    print('{:>10} {:>14} {:>14} {:>10}'.format('batch', 'per-sample ms', 'batched ms', 'speedup'))
+    for batch_size in [128, 384, 1024]:
+        logits = torch.randn(batch_size, args.num_classes, device=device)
+        targets = torch.randint(0, args.num_classes, (batch_size,), device=device)
+
+        def per_sample():
+            loss = [F.cross_entropy(logit_i.unsqueeze(0), target_i.unsqueeze(0)) for (logit_i, target_i) in zip(logits, targets)]
+            return np.array([loss_i.detach().cpu().numpy() for loss_i in loss])
+
+        def batched():
+            return utils.get_sample_losses(logits, targets)
+
+        assert np.allclose(per_sample(), batched(), atol=1e-5)
+        per_sample_time = time_function(per_sample, args.repeats)
+        batched_time = time_function(batched, args.repeats)
+        print('{:>10} {:>14.3f} {:>14.3f} {:>9.1f}x'.format(batch_size, per_sample_time*1000, batched_time*1000, per_sample_time/batched_time))
+
+CREATE_FUNCS = {'vgg': normal.create_vgg16bn, 'mobilenet': normal.create_mobile, 'resnet': normal.create_resnet56,
+                'wideresnet': normal.create_wideresnet32_4, 'lenet': normal.create_lenet, 'rnn': normal.create_rnn, 'rl': normal.create_rl}
+
+def create_benchmark_model(args, model, model_path, channels_last=0):
+    # the architectures read their settings from the training arguments
+    args = main.get_parser().parse_args(['--data', args.data, '--model', model, '--channels_last', str(channels_last)])
+    model_name = CREATE_FUNCS[model](model_path, args)
+    net, model_params = normal.load_model(args, model_path, model_name, epoch=0)
+    utils.set_memory_format(args, net, model_params)
+    return net, model_params
+
+def benchmark_training(args, device='cpu'):
+    # images/sec of the training step on random data, for each --precision and memory format
+    configs = [('fp32', 0), ('fp32', 1), ('bf16', 0), ('bf16', 1)]
+    print('{:>12} {:>10} {:>14} {:>14}'.format('model', 'precision', 'channels_last', 'images/sec'))
+    for model in args.models.split(','):
+        for precision, channels_last in configs:
+            with tempfile.TemporaryDirectory() as model_path:
+                net, model_params = create_benchmark_model(args, model, model_path, channels_last)
+            if channels_last and not any(name in model_params['network_type'] for name in utils.CHANNELS_LAST_NETWORKS):
+                continue
+            net = net.to(device)
+            net.train()
+            optimizer = torch.optim.SGD(net.parameters(), lr=0.01, momentum=0.9)
+            data = torch.randn(args.batch_size, model_params['port_num'], model_params['input_size'], model_params['input_size'])
+            labels = torch.randint(0, model_params['num_classes'], (args.batch_size,))
+            step_time = time_function(lambda: utils.cnn_training_step(net, optimizer, data, labels, device, precision), args.repeats)
+            print('{:>12} {:>10} {:>14} {:>14.1f}'.format(model, precision, channels_last, args.batch_size / step_time))
+
+def benchmark_inference(args, device='cpu'):
+    # forward-only images/sec of the eager network and of the compiled one with a second checkpoint swapped in
+    print('{:>12} {:>12} {:>14} {:>14} {:>14} {:>10}'.format('model', 'compile s', 'eager img/s', 'compiled img/s', 'swapped img/s', 'max diff'))
+    for model in args.models.split(','):
+        with tempfile.TemporaryDirectory() as model_path:
+            net, model_params = create_benchmark_model(args, model, model_path)
+            other_net, _ = create_benchmark_model(args, model, model_path)
+        net = net.to(device).eval()
+        other_net = other_net.to(device).eval()
+        data = torch.randn(args.batch_size, model_params['port_num'], model_params['input_size'], model_params['input_size'], device=device)
+
+        with torch.no_grad():
+            eager_time = time_function(lambda: net(data), args.repeats)
+            start_time = time.time()
+            compiled = utils.get_compiled_model(net, model_params, device)
+            output = compiled(data)
+            compile_time = time.time() - start_time
+            max_diff = (output - net(data)).abs().max().item()
+            compiled_time = time_function(lambda: compiled(data), args.repeats)
+
+            compiled = utils.get_compiled_model(other_net, model_params, device)
+            max_diff = max(max_diff, (compiled(data) - other_net(data)).abs().max().item())
+            swapped_time = time_function(lambda: compiled(data), args.repeats)
+        print('{:>12} {:>12.1f} {:>14.1f} {:>14.1f} {:>14.1f} {:>10.1e}'.format(model, compile_time, args.batch_size / eager_time,
+                                                                   args.batch_size / compiled_time, args.batch_size / swapped_time, max_diff))
+
+def benchmark_folding(args, device='cpu'):
+    # eval() forward of the trained layout against the BatchNorm-folded copy used for trajectory scoring
+    print('{:>12} {:>14} {:>14} {:>10} {:>10}'.format('model', 'eager img/s', 'folded img/s', 'speedup', 'max diff'))
+    for model in args.models.split(','):
+        with tempfile.TemporaryDirectory() as model_path:
+            net, model_params = create_benchmark_model(args, model, model_path)
+        net = net.to(device)
+        # one training pass so that the BatchNorm running statistics are not the identity
+        net.train()
+        data = torch.randn(args.batch_size, model_params['port_num'], model_params['input_size'], model_params['input_size'], device=device)
+        with torch.no_grad():
+            net(data)
+        net.eval()
+        folded = architectures.export_for_inference(net)
+
+        with torch.no_grad():
+            max_diff = (net(data) - folded(data)).abs().max().item()
+            eager_time = time_function(lambda: net(data), args.repeats)
+            folded_time = time_function(lambda: folded(data), args.repeats)
+        print('{:>12} {:>14.1f} {:>14.1f} {:>9.2f}x {:>10.1e}'.format(model, args.batch_size / eager_time, args.batch_size / folded_time,
+                                                                 eager_time / folded_time, max_diff))
+
+def benchmark_sisa(args, device='cpu'):
+    """Seconds to withdraw --deletions samples from a SISA target against retraining from scratch.
+
+    Trains the target of --data once as a single network and once as --num_shards shards of --num_slices slices
+    on the real split, then times each withdrawal, which only retrains the affected shards from their last clean slice.
+    """
+    for model in args.models.split(','):
+        train_args = main.get_parser().parse_args(['--data', args.data, '--model', model, '--epochs', str(args.epochs), '--num_shards', str(args.num_shards),
+                                                   '--num_slices', str(args.num_slices), '--shard_workers', str(args.shard_workers)])
+        with tempfile.TemporaryDirectory() as model_path:
+            single_args = main.get_parser().parse_args(['--data', args.data, '--model', model, '--epochs', str(args.epochs)])
+            model_name = CREATE_FUNCS[model](model_path + '/single', single_args)
+            start_time = time.time()
+            normal.train(single_args, model_path + '/single', model_name, device=device)
+            single_time = time.time() - start_time
+
+            CREATE_FUNCS[model](model_path + '/target', train_args)
+            start_time = time.time()
+            normal.train_sharded(train_args, model_path + '/target', model_name, device)
+            sharded_time = time.time() - start_time
+            num_samples = np.load(model_path + '/target/' + model_name + '/sisa_assignment.npy').shape[1]
+
+            rows = []
+            for deletions in [int(deletions) for deletions in args.deletions.split(',')]:
+                train_args.ratio = deletions / num_samples
+                model_path_wd = '{}/withdrawn_{}'.format(model_path, deletions)
+                start_time = time.time()
+                normal.withdraw(train_args, model_path + '/target', model_path_wd, model_name, device)
+                retrained = sum(os.path.isdir('{}/{}/{}'.format(model_path_wd, model_name, name)) for name in os.listdir(model_path_wd + '/' + model_name))
+                rows.append((deletions, retrained, time.time() - start_time))
+
+        print('{:>12} {:>10} {:>10} {:>10} {:>12} {:>12} {:>10}'.format('model', 'deletions', 'shards', 'delete s', 'single s', 'sharded s', 'speedup'))
+        for deletions, retrained, delete_time in rows:
+            print('{:>12} {:>10} {:>10} {:>10.1f} {:>12.1f} {:>12.1f} {:>9.1f}x'.format(model, deletions, '{}/{}'.format(retrained, args.num_shards),
+                                                                                 delete_time, single_time, sharded_time, single_time / delete_time))
+
+def get_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def benchmark_checkpoints(args, device='cpu'):
+    """Bytes on disk and load latency of --checkpoint_epochs distill snapshots, as torch.save files and in the compact store.
+
+    Consecutive snapshots are a few SGD steps on random data apart and the params grow with each epoch like the
+    training metrics do. The error columns are the largest weight difference and the largest logit difference,
+    relative to the largest logit, against the fp32 snapshots.
+    """
+    print('{:>12} {:>12} {:>10} {:>12} {:>12} {:>12} {:>12}'.format('model', 'format', 'MB', 'ordered ms', 'random ms', 'weight err', 'logit rel'))
+    for model in args.models.split(','):
+        load_args = main.get_parser().parse_args(['--data', args.data, '--model', model])
+        with tempfile.TemporaryDirectory() as model_path:
+            net, model_params = create_benchmark_model(args, model, model_path)
+            model_name = model_params['base_model']
+            net = net.to(device)
+            optimizer = torch.optim.SGD(net.parameters(), lr=0.01, momentum=0.9)
+            data = torch.randn(args.batch_size, model_params['port_num'], model_params['input_size'], model_params['input_size'], device=device)
+            labels = torch.randint(0, model_params['num_classes'], (args.batch_size,), device=device)
+
+            formats = {'torch.save': model_path + '/legacy'}
+            stores = {}
+            for keyframe_every in sorted(set([1, args.keyframe_every])):
+                name = 'fp16' if keyframe_every == 1 else 'delta/{}'.format(keyframe_every)
+                formats[name] = '{}/store_{}'.format(model_path, keyframe_every)
+                stores[name] = checkpoints.CheckpointStore(formats[name] + '/' + model_name, keyframe_every, reset=True)
+            check_epochs = sorted(set(np.random.RandomState(0).choice(np.arange(1, args.checkpoint_epochs + 1), 3).tolist() + [args.checkpoint_epochs]))
+            states = {}
+            for epoch in range(1, args.checkpoint_epochs + 1):
+                net.train()
+                for _ in range(args.steps_per_epoch):
+                    utils.cnn_training_step(net, optimizer, data, labels, device)
+                model_params.setdefault('test_top1_acc', []).append(0.0)
+                normal.save_model(net, model_params, formats['torch.save'], model_name, epoch=epoch)
+                for store in stores.values():
+                    store.save_epoch(epoch, net.state_dict(), model_params)
+                if epoch in check_epochs:
+                    states[epoch] = {name: tensor.detach().cpu().clone() for name, tensor in net.state_dict().items()}
+
+            order = np.random.RandomState(0).permutation(np.arange(1, args.checkpoint_epochs + 1)).tolist()
+            for name, path in formats.items():
+                size = get_size(path + '/' + model_name)
+                start_time = time.time()
+                for epoch in range(1, args.checkpoint_epochs + 1):
+                    normal.load_model(load_args, path, model_name, epoch=epoch)
+                ordered_time = (time.time() - start_time) / args.checkpoint_epochs
+                start_time = time.time()
+                for epoch in order:
+                    normal.load_model(load_args, path, model_name, epoch=epoch)
+                random_time = (time.time() - start_time) / args.checkpoint_epochs
+
+                weight_error = 0.0
+                logit_error = 0.0
+                reference = copy.deepcopy(net).eval()
+                for epoch in check_epochs:
+                    loaded, _ = normal.load_model(load_args, path, model_name, epoch=epoch)
+                    loaded = loaded.to(device).eval()
+                    reference.load_state_dict(states[epoch])
+                    for key, tensor in loaded.state_dict().items():
+                        if tensor.is_floating_point():
+                            weight_error = max(weight_error, (tensor.cpu() - states[epoch][key]).abs().max().item())
+                    with torch.no_grad():
+                        reference_logits = reference(data)
+                        logit_error = max(logit_error, (loaded(data) - reference_logits).abs().max().item() / reference_logits.abs().max().item())
+                print('{:>12} {:>12} {:>10.1f} {:>12.1f} {:>12.1f} {:>12.1e} {:>12.1e}'.format(model, name, size / 2**20, ordered_time * 1000,
+                                                                                       random_time * 1000, weight_error, logit_error))
+
+def benchmark_weight_bank(args, device='cpu'):
+    """Per-epoch load latency of --checkpoint_epochs distill snapshots from torch.save files and from a weight bank.
+
+    The bank is read once through normal.load_model, which builds a network per epoch, and once by pointing one
+    prebuilt network at each row as the trajectory checkpoint pools do.
+    """
+    print('{:>12} {:>16} {:>10} {:>12} {:>12}'.format('model', 'format', 'MB', 'ms/epoch', 'max diff'))
+    for model in args.models.split(','):
+        load_args = main.get_parser().parse_args(['--data', args.data, '--model', model])
+        with tempfile.TemporaryDirectory() as model_path:
+            net, model_params = create_benchmark_model(args, model, model_path)
+            model_name = model_params['base_model']
+            net = net.to(device)
+            optimizer = torch.optim.SGD(net.parameters(), lr=0.01, momentum=0.9)
+            data = torch.randn(args.batch_size, model_params['port_num'], model_params['input_size'], model_params['input_size'], device=device)
+            labels = torch.randint(0, model_params['num_classes'], (args.batch_size,), device=device)
+
+            bank = checkpoints.WeightBank.create(model_path + '/bank/' + model_name, net, args.checkpoint_epochs)
+            for epoch in range(1, args.checkpoint_epochs + 1):
+                net.train()
+                for _ in range(args.steps_per_epoch):
+                    utils.cnn_training_step(net, optimizer, data, labels, device)
+                normal.save_model(net, model_params, model_path + '/legacy', model_name, epoch=epoch)
+                bank.write(epoch, net, model_params)
+            bank = checkpoints.get_bank(model_path + '/bank/' + model_name)
+            template, _ = normal.load_model(load_args, model_path + '/bank', model_name, epoch=1)
+            template = template.to(device).eval()
+            reference = copy.deepcopy(net).eval()
+
+            loads = [('torch.save', model_path + '/legacy', lambda epoch: normal.load_model(load_args, model_path + '/legacy', model_name, epoch=epoch)[0]),
+                     ('bank load_model', model_path + '/bank', lambda epoch: normal.load_model(load_args, model_path + '/bank', model_name, epoch=epoch)[0]),
+                     ('bank template', model_path + '/bank', lambda epoch: bank.load_into(template, epoch))]
+            for name, path, load in loads:
+                start_time = time.time()
+                for epoch in range(1, args.checkpoint_epochs + 1):
+                    loaded = load(epoch)
+                load_time = (time.time() - start_time) / args.checkpoint_epochs
+                # the last epoch is the state of `net`
+                with torch.no_grad():
+                    max_diff = (loaded.to(device).eval()(data) - reference(data)).abs().max().item()
+                print('{:>12} {:>16} {:>10.1f} {:>12.2f} {:>12.1e}'.format(model, name, get_size(path + '/' + model_name) / 2**20, load_time * 1000, max_diff))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TrajectoryMIA benchmarks')
+    parser.add_argument('--bench', type=str, default='loss', help=['loss', 'train', 'inference', 'fold', 'sisa', 'checkpoints', 'bank'])
+    parser.add_argument('--num_classes', type=int, default=100)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--data', type=str, default='cifar100')
+    parser.add_argument('--models', type=str, default='resnet,wideresnet,vgg,mobilenet', help='comma separated architectures for --bench train, inference and fold')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--epochs', type=int, default=10, help='training epochs of --bench sisa')
+    parser.add_argument('--num_shards', type=int, default=5)
+    parser.add_argument('--num_slices', type=int, default=5)
+    parser.add_argument('--shard_workers', type=int, default=1)
+    parser.add_argument('--checkpoint_epochs', type=int, default=20, help='snapshots written by --bench checkpoints and bank')
+    parser.add_argument('--keyframe_every', type=int, default=10)
+    parser.add_argument('--steps_per_epoch', type=int, default=5, help='SGD steps between two snapshots of --bench checkpoints')
+    parser.add_argument('--deletions', type=str, default='1,10,100', help='comma separated withdrawal sizes of --bench sisa')
+
+    args = parser.parse_args()
+    device = utils.get_pytorch_device()
+
+    if args.bench == 'loss':
+        benchmark_sample_losses(args, device)
+    elif args.bench == 'train':
+        benchmark_training(args, device)
+    elif args.bench == 'inference':
+        benchmark_inference(args, device)
+    elif args.bench == 'fold':
+        benchmark_folding(args, device)
+    elif args.bench == 'sisa':
+        benchmark_sisa(args, device)
+    elif args.bench == 'checkpoints':
+        benchmark_checkpoints(args, device)
+    elif args.bench == 'bank':
+        benchmark_weight_bank(args, device)
@@ -0,0 +1,239 @@
+import os
+import json
+import shutil
+import pickle
+import numpy as np
+import torch
+
+STORE_NAME = 'checkpoints'
+MANIFEST_NAME = 'manifest.json'
+PARAMS_NAME = 'parameters.pkl'
+BANK_NAME = 'weight_bank'
+
+_open_stores = {}
+_open_banks = {}
+
+class CheckpointStore(object):
+    """Compact per-epoch snapshots of one network under {network_path}/checkpoints.
+
+    Every keyframe_every-th epoch (and the first) is a keyframe holding each float weight matrix or kernel in fp16,
+    one-dimensional tensors are kept in full precision in every epoch. The epochs
+    in between only hold per-tensor int8 deltas against the reconstruction of the previous epoch, with one fp32
+    scale per tensor, and tensors that did not change are left out. The deltas are taken against what a reader
+    reconstructs, so the rounding error stays at one quantization step instead of adding up along the chain.
+    The model_params of all epochs share one parameters.pkl, written again with each epoch.
+    """
+    def __init__(self, network_path, keyframe_every=10, reset=False):
+        self.path = os.path.join(network_path, STORE_NAME)
+        self.manifest_path = os.path.join(self.path, MANIFEST_NAME)
+        if os.path.exists(self.manifest_path) and not reset:
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'keyframe_every': keyframe_every, 'epochs': {}}
+        self.params = None
+        # the last reconstructed epoch, so that reading the epochs in order reads one file per epoch
+        self.last_epoch = None
+        self.last_state = None
+
+    def __contains__(self, epoch):
+        return str(epoch) in self.manifest['epochs']
+
+    def is_keyframe(self, epoch):
+        return self.manifest['epochs'][str(epoch)]['keyframe']
+
+    def get_file(self, epoch):
+        return os.path.join(self.path, '{}.pt'.format(epoch))
+
+    def save_epoch(self, epoch, state_dict, model_params=None):
+        os.makedirs(self.path, exist_ok=True)
+        keyframe = (epoch - 1) % self.manifest['keyframe_every'] == 0 or self.last_epoch != epoch - 1
+        state = {name: tensor.detach().cpu().clone() for name, tensor in state_dict.items()}
+        tensors = {}
+        for name, tensor in state.items():
+            if not tensor.is_floating_point() or tensor.dim() <= 1:
+                # biases, BatchNorm affine parameters and running statistics are a small part of the bytes but
+                # fp16 running variances visibly shift the logits, so they are kept as they are
+                tensors[name] = tensor
+            elif keyframe:
+                tensors[name] = tensor.half()
+                state[name] = tensors[name].float()
+            else:
+                delta = tensor.float() - self.last_state[name]
+                scale = delta.abs().max().item() / 127
+                if scale == 0:
+                    state[name] = self.last_state[name]
+                    continue
+                tensors[name] = {'delta': torch.round(delta / scale).to(torch.int8), 'scale': scale}
+                state[name] = decode_delta(self.last_state[name], tensors[name])
+        torch.save({'keyframe': keyframe, 'tensors': tensors}, self.get_file(epoch))
+
+        if model_params is not None:
+            with open(os.path.join(self.path, PARAMS_NAME), 'wb') as f:
+                pickle.dump(model_params, f, pickle.HIGHEST_PROTOCOL)
+            self.params = model_params
+        # recorded last, an epoch whose file is incomplete is not listed
+        self.manifest['epochs'][str(epoch)] = {'keyframe': keyframe, 'bytes': os.path.getsize(self.get_file(epoch))}
+        with open(self.manifest_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        self.last_epoch = epoch
+        self.last_state = state
+
+    def load_params(self):
+        if self.params is None:
+            with open(os.path.join(self.path, PARAMS_NAME), 'rb') as f:
+                self.params = pickle.load(f)
+        return self.params
+
+    def load_epoch(self, epoch):
+        """Returns the float32 state_dict of `epoch`, reading its keyframe and the deltas after it only as needed"""
+        if epoch not in self:
+            raise KeyError('Epoch {} is not in {}'.format(epoch, self.path))
+        if epoch == self.last_epoch:
+            return dict(self.last_state)
+        start = epoch
+        while not self.is_keyframe(start):
+            if start - 1 == self.last_epoch:
+                break
+            start -= 1
+
+        state = None if self.is_keyframe(start) else self.last_state
+        for current in range(start, epoch + 1):
+            checkpoint = torch.load(self.get_file(current), map_location='cpu')
+            state = decode_checkpoint(state, checkpoint)
+        self.last_epoch = epoch
+        self.last_state = state
+        return dict(state)
+
+    def num_bytes(self):
+        return sum(entry['bytes'] for entry in self.manifest['epochs'].values()) + os.path.getsize(os.path.join(self.path, PARAMS_NAME))
+
+def decode_delta(previous, entry):
+    return previous + entry['delta'].float() * entry['scale']
+
+def decode_checkpoint(previous, checkpoint):
+    state = {} if checkpoint['keyframe'] else dict(previous)
+    for name, entry in checkpoint['tensors'].items():
+        if isinstance(entry, dict):
+            state[name] = decode_delta(previous[name], entry)
+        elif entry.is_floating_point():
+            state[name] = entry.float()
+        else:
+            state[name] = entry
+    return state
+
+def get_store(network_path):
+    """The store under network_path if one was written there, shared between the readers of that path"""
+    manifest_path = os.path.join(network_path, STORE_NAME, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    # reopened when the store was written since, e.g. by a new training run in the same process
+    modified = os.path.getmtime(manifest_path)
+    if network_path not in _open_stores or _open_stores[network_path][0] != modified:
+        _open_stores[network_path] = (modified, CheckpointStore(network_path))
+    return _open_stores[network_path][1]
+
+def remove_store(network_path):
+    """Deletes the store under network_path, so that readers fall back to the snapshots of a later run"""
+    path = os.path.join(network_path, STORE_NAME)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    _open_stores.pop(network_path, None)
+
+class WeightBank(object):
+    """Every per-epoch snapshot of one network as a row of a single [epochs, num_values] float32 memmap.
+
+    {network_path}/weight_bank.npy holds the parameters in model.parameters() order followed by the buffers,
+    and weight_bank.json the layout and the epochs written so far. load_into points the parameters and float
+    buffers of an already built network at the row of an epoch without copying it, so switching epochs opens
+    and unpickles nothing.
+    """
+    def __init__(self, network_path):
+        self.path = os.path.join(network_path, BANK_NAME)
+        with open(self.path + '.json', 'r') as f:
+            self.manifest = json.load(f)
+        # copy-on-write, so that the rows can back writable tensors while the file is never modified
+        self.values = np.load(self.path + '.npy', mmap_mode='c')
+        self.params = None
+
+    @classmethod
+    def create(cls, network_path, model, num_epochs):
+        path = os.path.join(network_path, BANK_NAME)
+        os.makedirs(network_path, exist_ok=True)
+        layout = [{'name': name, 'shape': list(tensor.shape), 'dtype': str(tensor.dtype).replace('torch.', ''), 'kind': kind}
+                  for kind, tensors in [('parameter', model.named_parameters()), ('buffer', model.named_buffers())] for name, tensor in tensors]
+        num_values = sum(int(np.prod(entry['shape'])) for entry in layout)
+        np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=np.float32, shape=(num_epochs, num_values)).flush()
+        with open(path + '.json', 'w') as f:
+            json.dump({'num_epochs': num_epochs, 'num_values': num_values, 'layout': layout, 'epochs': []}, f, indent=2)
+        return cls(network_path)
+
+    def __contains__(self, epoch):
+        return epoch in self.manifest['epochs']
+
+    def write(self, epoch, model, model_params=None):
+        values = np.lib.format.open_memmap(self.path + '.npy', mode='r+')
+        tensors = list(model.parameters()) + list(model.buffers())
+        values[epoch - 1] = torch.cat([tensor.detach().reshape(-1).float().cpu() for tensor in tensors]).numpy()
+        values.flush()
+        del values
+
+        if model_params is not None:
+            with open(self.path + '.pkl', 'wb') as f:
+                pickle.dump(model_params, f, pickle.HIGHEST_PROTOCOL)
+            self.params = model_params
+        # recorded last, a row that is not listed may be incomplete
+        if epoch not in self.manifest['epochs']:
+            self.manifest['epochs'].append(epoch)
+        with open(self.path + '.json', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+
+    def load_params(self):
+        if self.params is None:
+            with open(self.path + '.pkl', 'rb') as f:
+                self.params = pickle.load(f)
+        return self.params
+
+    def load_into(self, model, epoch):
+        """Points the parameters and buffers of `model`, built with this layout, at the row of `epoch`"""
+        if epoch not in self:
+            raise KeyError('Epoch {} is not in {}.npy'.format(epoch, self.path))
+        parameters = list(model.parameters())
+        buffers = list(model.buffers())
+        if len(parameters) + len(buffers) != len(self.manifest['layout']):
+            raise ValueError('The network does not match the layout of {}.json'.format(self.path))
+        device = parameters[0].device
+        vector = torch.from_numpy(self.values[epoch - 1])
+        if device.type != 'cpu':
+            vector = vector.to(device)
+        num_parameter_values = sum(parameter.numel() for parameter in parameters)
+        torch.nn.utils.vector_to_parameters(vector[:num_parameter_values], parameters)
+
+        offset = num_parameter_values
+        for buffer in buffers:
+            values = vector[offset:offset+buffer.numel()].view_as(buffer)
+            if buffer.is_floating_point():
+                buffer.data = values
+            else:
+                buffer.copy_(values)
+            offset += buffer.numel()
+        return model
+
+def get_bank(network_path):
+    """The weight bank under network_path if one was written there, shared between the readers of that path"""
+    manifest_path = os.path.join(network_path, BANK_NAME + '.json')
+    if not os.path.exists(manifest_path):
+        return None
+    modified = os.path.getmtime(manifest_path)
+    if network_path not in _open_banks or _open_banks[network_path][0] != modified:
+        _open_banks[network_path] = (modified, WeightBank(network_path))
+    return _open_banks[network_path][1]
+
+def remove_bank(network_path):
+    """Deletes the weight bank under network_path, so that readers fall back to the snapshots of a later run"""
+    path = os.path.join(network_path, BANK_NAME)
+    for extension in ['.json', '.npy', '.pkl']:
+        # the manifest goes first, without it the bank is not opened
+        if os.path.exists(path + extension):
+            os.remove(path + extension)
+    _open_banks.pop(network_path, None)
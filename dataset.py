@@ -26,6 +26,175 @@ from torch.utils.data import Dataset, DataLoader
 from torchvision import datasets, transforms
 from torch.utils.data import ConcatDataset
 
+CACHE_ROOT = './c01yili/datasets/cache'
+SPLIT_ROOT = './c01yili/datasets/splits'
+
+# split lengths passed to dataset_split and the (train, test) position of each split; the distill test split
+# reuses the shadow test split where the dataset has no dedicated one
+SPLITS = {
+    'mnist': ([10000, 10000, 10000, 10000, 20000, 10000], {'target': (0, 1), 'shadow': (2, 3), 'distill': (4, 5)}),
+    'gtsrb': ([1500, 1500, 1500, 1500, 45838], {'target': (0, 1), 'shadow': (2, 3), 'distill': (4, 3)}),
+    'cinic10': ([10000, 10000, 10000, 10000, 220000, 10000], {'target': (0, 1), 'shadow': (2, 3), 'distill': (4, 5)}),
+    'cifar10': ([10000, 10000, 10000, 10000, 20000], {'target': (0, 1), 'shadow': (2, 3), 'distill': (4, 3)}),
+    'cifar100': ([10000, 10000, 10000, 10000, 20000], {'target': (0, 1), 'shadow': (2, 3), 'distill': (4, 3)}),
+}
+
+_base_datasets = {}
+
+def split_name(mode):
+    return 'distill' if 'distill' in mode else mode
+
+def save_array(path, array):
+    """np.save through a temporary file of this process, so that a process reading the cache concurrently never
+    sees a partly written file and two processes building it at once do not write into the same file"""
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(temp_path, path)
+
+def get_split_permutation(name):
+    """The permutation dataset_split draws for `name`, computed once and cached under SPLIT_ROOT"""
+    lengths = SPLITS[name][0]
+    path = os.path.join(SPLIT_ROOT, '{}.npy'.format(name))
+    if os.path.exists(path):
+        indices = np.load(path)
+        if len(indices) == sum(lengths):
+            return indices
+    # same draws as np.random.seed(1); np.random.shuffle(...) in dataset_split, without reseeding the global generator
+    indices = np.arange(sum(lengths))
+    np.random.RandomState(1).shuffle(indices)
+    os.makedirs(SPLIT_ROOT, exist_ok=True)
+    save_array(path, indices)
+    return indices
+
+def get_split_indices(name, mode, train):
+    """Global sample ids of one split, i.e. positions in the base dataset of `name` that concatenates its original
+    train and test partitions (train, test and valid for cinic10). The SUB* datasets return them as the third
+    item of every sample."""
+    lengths, positions = SPLITS[name]
+    position = positions[split_name(mode)][0 if train else 1]
+    offset = sum(lengths[:position+1])
+    return get_split_permutation(name)[offset - lengths[position]:offset].tolist()
+
+def get_positions(split, ids):
+    """Positions in `split` of the global sample ids its items return"""
+    if not hasattr(split, 'positions'):
+        index = np.asarray(split.index)
+        split.positions = np.full(index.max() + 1, -1, dtype=np.int64)
+        split.positions[index] = np.arange(len(index))
+    return split.positions[np.asarray(ids)]
+
+def get_base_dataset(name, aug, build):
+    # the train and test split of one wrapper share the concatenated base dataset instead of building it twice
+    if (name, aug) not in _base_datasets:
+        base_dataset = build()
+        if sum(SPLITS[name][0]) != len(base_dataset):
+            raise ValueError("Sum of input lengths does not equal the length of the input dataset!")
+        _base_datasets[(name, aug)] = base_dataset
+    return _base_datasets[(name, aug)]
+
+class CachedSplit(Dataset):
+    """One dataset split held as a uint8 NCHW array on disk, decoded and normalized a whole batch at a time.
+
+    Augmented splits apply the random horizontal flip and zero-padded random crop of the torchvision pipelines
+    to the batch tensor instead of to each PIL image.
+    """
+    def __init__(self, images, labels, mean, std, aug, padding=4, channels=3, index=None):
+        self.images = images
+        self.labels = labels
+        self.index = np.arange(len(labels)) if index is None else np.asarray(index)
+        self.aug = aug
+        self.padding = padding
+        self.channels = channels
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def get_batch(self, indices):
+        indices = np.asarray(indices)
+        x = torch.from_numpy(np.ascontiguousarray(self.images[indices]))
+        if self.aug:
+            x = random_flip_crop(x, self.padding)
+        if x.size(1) != self.channels:
+            x = x.expand(-1, self.channels, -1, -1)
+        x = (x.float().div_(255) - self.mean) / self.std
+        y = torch.from_numpy(np.asarray(self.labels[indices], dtype=np.int64))
+        return x, y, torch.from_numpy(self.index[indices])
+
+    def __getitem__(self, idx):
+        x, y, ids = self.get_batch([idx])
+        return x[0], y[0], int(ids[0])
+
+    def __len__(self):
+        return len(self.labels)
+
+class CachedSplitLoader(object):
+    def __init__(self, dataset, batch_size, shuffle=False, indices=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_workers = 0
+        self.indices = np.arange(len(dataset)) if indices is None else np.asarray(indices)
+
+    def __iter__(self):
+        order = self.indices[torch.randperm(len(self.indices)).numpy()] if self.shuffle else self.indices
+        for start in range(0, len(order), self.batch_size):
+            yield self.dataset.get_batch(order[start:start+self.batch_size])
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+def subset_loader(loader, indices, shuffle=True):
+    """Loader over the samples of `loader` at the split positions `indices`, each item keeps its position in the split"""
+    if isinstance(loader, CachedSplitLoader):
+        return CachedSplitLoader(loader.dataset, loader.batch_size, shuffle, indices)
+    return DataLoader(Subset(loader.dataset, indices), batch_size=loader.batch_size, shuffle=shuffle, num_workers=loader.num_workers)
+
+def random_flip_crop(x, padding):
+    batch_size, _, height, width = x.size()
+    flip = torch.rand(batch_size) < 0.5
+    x = torch.where(flip.view(-1, 1, 1, 1), x.flip(3), x)
+    padded = torch.nn.functional.pad(x, (padding, padding, padding, padding))
+    top = torch.randint(0, 2 * padding + 1, (batch_size,))
+    left = torch.randint(0, 2 * padding + 1, (batch_size,))
+    rows = (top.view(-1, 1) + torch.arange(height)).view(batch_size, 1, height, 1)
+    cols = (left.view(-1, 1) + torch.arange(width)).view(batch_size, 1, 1, width)
+    return padded[torch.arange(batch_size).view(-1, 1, 1, 1), torch.arange(x.size(1)).view(1, -1, 1, 1), rows, cols]
+
+def load_cached_split(name, split, train, build_arrays):
+    """Returns the (images, labels) of one split, materializing them under CACHE_ROOT on first use"""
+    path = os.path.join(CACHE_ROOT, '{}_{}_{}'.format(name, split, 'train' if train else 'test'))
+    if not os.path.exists(path + '_labels.npy'):
+        print('Caching {} {} split to {} ...'.format(name, split, path))
+        os.makedirs(CACHE_ROOT, exist_ok=True)
+        images, labels = build_arrays()
+        # the labels are moved into place last, their file marks the split as complete
+        save_array(path + '_images.npy', images)
+        save_array(path + '_labels.npy', labels)
+    return np.load(path + '_images.npy', mmap_mode='r'), np.load(path + '_labels.npy')
+
+def torchvision_split_arrays(name, dataset_class, root, mode, train):
+    trainset = dataset_class(root=root, train=True, download=True)
+    testset = dataset_class(root=root, train=False, download=True)
+    images = np.concatenate([np.asarray(trainset.data), np.asarray(testset.data)])
+    if images.ndim == 3:
+        images = images[:, None, :, :]
+    else:
+        images = images.transpose(0, 3, 1, 2)
+    labels = np.concatenate([np.asarray(trainset.targets), np.asarray(testset.targets)]).astype(np.int64)
+    indices = get_split_indices(name, mode, train)
+    return np.ascontiguousarray(images[indices]), labels[indices]
+
+def set_cached_loaders(holder, name, mode, aug, batch_size, dataset_class, root, mean, std):
+    """Sets the `[aug_]{split}_trainset/_train_loader/_testset/_test_loader` attributes from the tensor cache"""
+    split = split_name(mode)
+    prefix = 'aug_' + split if aug else split
+    for train in [True, False]:
+        images, labels = load_cached_split(name, split, train, lambda: torchvision_split_arrays(name, dataset_class, root, mode, train))
+        subset = CachedSplit(images, labels, mean, std, aug, index=get_split_indices(name, mode, train))
+        part = 'train' if train else 'test'
+        setattr(holder, '{}_{}set'.format(prefix, part), subset)
+        setattr(holder, '{}_{}_loader'.format(prefix, part), CachedSplitLoader(subset, batch_size, shuffle=train))
+
 class SUBMNIST(Dataset):
     def __init__(self, mode, aug, train):
         self.img_size = 28  # MNIST 图像大小为 28x28
@@ -50,37 +219,13 @@ class SUBMNIST(Dataset):
             normalize
         ])
 
-        # 加载 MNIST 数据集
-        self.aug_trainset = datasets.MNIST(root='./c01yili/datasets/MNIST', train=True, download=True, transform=self.augmented)
-        self.aug_testset = datasets.MNIST(root='./c01yili/datasets/MNIST', train=False, download=True, transform=self.augmented)
-        self.trainset = datasets.MNIST(root='./c01yili/datasets/MNIST', train=True, download=True, transform=self.normalized)
-        self.testset = datasets.MNIST(root='./c01yili/datasets/MNIST', train=False, download=True, transform=self.normalized)
-
-        # 连接数据集
-        self.aug_dataset = ConcatDataset([self.aug_trainset, self.aug_testset])
-        self.dataset = ConcatDataset([self.trainset, self.testset])
-
-        # 数据集分割
-        self.aug_target_trainset, self.aug_target_testset, self.aug_shadow_trainset, self.aug_shadow_testset, self.aug_distill_trainset, self.aug_distill_testset = dataset_split(self.aug_dataset, [10000, 10000, 10000, 10000, 20000, 10000])
-        self.target_trainset, self.target_testset, self.shadow_trainset, self.shadow_testset, self.distill_trainset, self.distill_testset = dataset_split(self.dataset, [10000, 10000, 10000, 10000, 20000, 10000])
-
-        if mode == 'target':
-            if aug:
-                self.dataset = self.aug_target_trainset if train else self.aug_target_testset
-            else:
-                self.dataset = self.target_trainset if train else self.target_testset
-        elif mode == 'shadow':
-            if aug:
-                self.dataset = self.aug_shadow_trainset if train else self.aug_shadow_testset
-            else:
-                self.dataset = self.shadow_trainset if train else self.shadow_testset
-        elif 'distill' in mode:
-            if aug:
-                self.dataset = self.aug_distill_trainset if train else self.aug_distill_testset
-            else:
-                self.dataset = self.distill_trainset if train else self.distill_testset
-
-        self.index = range(int(len(self.dataset)))
+        # 只加载所需的划分
+        transform = self.augmented if aug else self.normalized
+        base_dataset = get_base_dataset('mnist', aug, lambda: ConcatDataset([
+            datasets.MNIST(root='./c01yili/datasets/MNIST', train=True, download=True, transform=transform),
+            datasets.MNIST(root='./c01yili/datasets/MNIST', train=False, download=True, transform=transform)]))
+        self.index = get_split_indices('mnist', mode, train)
+        self.dataset = Subset(base_dataset, self.index)
 
     def __getitem__(self, idx):
         return self.dataset[idx][0], self.dataset[idx][1], self.index[idx]
@@ -89,13 +234,16 @@ class SUBMNIST(Dataset):
         return len(self.index)
 
 class MNIST:
-    def __init__(self, mode, aug, batch_size=128):
+    def __init__(self, mode, aug, batch_size=128, cache=False):
         self.batch_size = batch_size
         self.img_size = 28
         self.num_classes = 10
         self.port_num = 3
         
-        if aug:
+        if cache:
+            set_cached_loaders(self, 'mnist', mode, aug, batch_size, datasets.MNIST, './c01yili/datasets/MNIST',
+                               [0.1307, 0.1307, 0.1307], [0.3081, 0.3081, 0.3081])
+        elif aug:
             if mode == 'target':
                 self.aug_target_trainset = SUBMNIST(mode, aug, True)
                 self.aug_target_train_loader = DataLoader(self.aug_target_trainset, batch_size=batch_size, shuffle=True, num_workers=2)
@@ -160,6 +308,48 @@ class GTSRB_ORI(data.Dataset):
 
         return img, classId
 
+def pack_gtsrb(root_dir, train, img_size=32):
+    """One-time conversion of the GTSRB csv + image tree into a resized uint8 image array and a label array"""
+    original = GTSRB_ORI(root_dir=root_dir, train=train, transform=transforms.Resize((img_size, img_size)))
+    images_path = GTSRB_PACKED.packed_path(root_dir, train, 'images')
+    temp_path = '{}.{}.tmp'.format(images_path, os.getpid())
+    images = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8, shape=(len(original), img_size, img_size, 3))
+    labels = np.empty(len(original), dtype=np.int64)
+    print('Packing GTSRB {} to {} ...'.format(original.sub_directory, images_path))
+    for idx in range(len(original)):
+        img, classId = original[idx]
+        images[idx] = np.asarray(img.convert('RGB'))
+        labels[idx] = classId
+    images.flush()
+    del images
+    save_array(GTSRB_PACKED.packed_path(root_dir, train, 'labels'), labels)
+    # the images are moved into place last, their file marks the split as packed
+    os.replace(temp_path, images_path)
+
+class GTSRB_PACKED(data.Dataset):
+    """GTSRB served from the packed arrays written by pack_gtsrb, normalized without going through PIL"""
+    base_folder = 'GTSRB'
+    def __init__(self, root_dir, train=False, mean=(0., 0., 0.), std=(1., 1., 1.)):
+        if not os.path.exists(self.packed_path(root_dir, train, 'images')):
+            pack_gtsrb(root_dir, train)
+        self.images = np.load(self.packed_path(root_dir, train, 'images'), mmap_mode='r')
+        self.labels = np.load(self.packed_path(root_dir, train, 'labels'))
+        self.mean = torch.tensor(mean).view(-1, 1, 1)
+        self.std = torch.tensor(std).view(-1, 1, 1)
+
+    @classmethod
+    def packed_path(cls, root_dir, train, part):
+        sub_directory = 'trainingset' if train else 'testset'
+        return os.path.join(root_dir, cls.base_folder, sub_directory, 'packed_{}.npy'.format(part))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        img = torch.from_numpy(np.array(self.images[idx])).permute(2, 0, 1).float().div(255)
+        img = (img - self.mean) / self.std
+        return img, int(self.labels[idx])
+
 class SUBGTSRB(data.Dataset):
     def __init__(self, mode, aug, train):
         self.img_size = 32
@@ -170,55 +360,12 @@ class SUBGTSRB(data.Dataset):
         self.augmented = transforms.Compose([transforms.Resize((32,32)), transforms.ToTensor(), normalize])
         self.normalized = transforms.Compose([transforms.ToTensor(), normalize])    
 
-        self.aug_trainset = GTSRB_ORI(root_dir='./c01yili/datasets/GTSRB', train=True, transform=self.augmented)
-        self.aug_testset = GTSRB_ORI(root_dir='./c01yili/datasets/GTSRB', train=False, transform=self.augmented)
-        self.trainset = GTSRB_ORI(root_dir='./c01yili/datasets/GTSRB', train=True, transform=self.normalized)
-        self.testset = GTSRB_ORI(root_dir='./c01yili/datasets/GTSRB', train=False, transform=self.normalized)
-               
-        self.aug_dataset = ConcatDataset([self.aug_trainset, self.aug_testset])
-        self.dataset = ConcatDataset([self.trainset, self.testset])
-
-        self.aug_target_trainset, self.aug_target_testset, self.aug_shadow_trainset, self.aug_shadow_testset, self.aug_distill_trainset = dataset_split(self.aug_dataset, [1500, 1500, 1500, 1500, 45838])
-        self.aug_distill_testset = self.aug_shadow_testset
-        self.target_trainset, self.target_testset, self.shadow_trainset, self.shadow_testset, self.distill_trainset = dataset_split(self.dataset, [1500, 1500, 1500, 1500, 45838])
-        self.distill_testset = self.shadow_testset
-
-        if mode == 'target':
-            if aug:
-                if train:
-                    self.dataset = self.aug_target_trainset
-                else:
-                    self.dataset = self.aug_target_testset
-            else:
-                if train:
-                    self.dataset = self.target_trainset
-                else:
-                    self.dataset = self.target_testset
-        elif mode == 'shadow':
-            if aug:
-                if train:
-                    self.dataset = self.aug_shadow_trainset
-                else:
-                    self.dataset = self.aug_shadow_testset
-            else:
-                if train:
-                    self.dataset = self.shadow_trainset
-                else:
-                    self.dataset = self.shadow_testset
-        elif 'distill' in mode:
-            if aug:
-                if train:
-                    self.dataset = self.aug_distill_trainset
-                else:
-                    self.dataset = self.aug_distill_testset
-            else:
-                if train:
-                    self.dataset = self.distill_trainset
-                else:
-                    self.dataset = self.distill_testset
-
-        self.index = range(int(len(self.dataset)))
-
+        # the packed images are already resized to 32x32, so the augmented and normalized pipelines coincide
+        base_dataset = get_base_dataset('gtsrb', aug, lambda: ConcatDataset([
+            GTSRB_PACKED(root_dir='./c01yili/datasets/GTSRB', train=True, mean=self.mean, std=self.std),
+            GTSRB_PACKED(root_dir='./c01yili/datasets/GTSRB', train=False, mean=self.mean, std=self.std)]))
+        self.index = get_split_indices('gtsrb', mode, train)
+        self.dataset = Subset(base_dataset, self.index)
 
     def __getitem__(self, idx):
         return self.dataset[idx][0], self.dataset[idx][1], self.index[idx]
@@ -278,55 +425,13 @@ class SUBCINIC10(data.Dataset):
 
         self.normalized = transforms.Compose([transforms.ToTensor(), normalize])
 
-        self.aug_trainset =  datasets.ImageFolder(root='./c01yili/datasets/cinic/train', transform=self.augmented)
-        self.aug_testset =  datasets.ImageFolder(root='./c01yili/datasets/cinic/test', transform=self.augmented)
-        self.aug_validset =  datasets.ImageFolder(root='./c01yili/datasets/cinic/valid', transform=self.augmented)
-        self.trainset =  datasets.ImageFolder(root='./c01yili/datasets/cinic/train', transform=self.normalized)
-        self.testset =  datasets.ImageFolder(root='./c01yili/datasets/cinic/test', transform=self.normalized)
-        self.validset =  datasets.ImageFolder(root='./c01yili/datasets/cinic/valid', transform=self.normalized)
-
-        self.aug_dataset = ConcatDataset([self.aug_trainset, self.aug_testset, self.aug_validset])
-        self.dataset = ConcatDataset([self.trainset, self.testset, self.validset])
-        
-        self.aug_target_trainset, self.aug_target_testset, self.aug_shadow_trainset, self.aug_shadow_testset, self.aug_distill_trainset, self.aug_distill_testset = dataset_split(self.aug_dataset, [10000, 10000, 10000, 10000, 220000, 10000])
-        self.target_trainset, self.target_testset, self.shadow_trainset, self.shadow_testset, self.distill_trainset, self.distill_testset = dataset_split(self.dataset, [10000, 10000, 10000, 10000, 220000, 10000])
-
-        if mode == 'target':
-            if aug:
-                if train:
-                    self.dataset = self.aug_target_trainset
-                else:
-                    self.dataset = self.aug_target_testset
-            else:
-                if train:
-                    self.dataset = self.target_trainset
-                else:
-                    self.dataset = self.target_testset
-        elif mode == 'shadow':
-            if aug:
-                if train:
-                    self.dataset = self.aug_shadow_trainset
-                else:
-                    self.dataset = self.aug_shadow_testset
-            else:
-                if train:
-                    self.dataset = self.shadow_trainset
-                else:
-                    self.dataset = self.shadow_testset
-        elif 'distill' in mode:
-            if aug:
-                if train:
-                    self.dataset = self.aug_distill_trainset
-                else:
-                    self.dataset = self.aug_distill_testset
-            else:
-                if train:
-                    self.dataset = self.distill_trainset
-                else:
-                    self.dataset = self.distill_testset
-
-        self.index = range(int(len(self.dataset)))
-
+        transform = self.augmented if aug else self.normalized
+        base_dataset = get_base_dataset('cinic10', aug, lambda: ConcatDataset([
+            datasets.ImageFolder(root='./c01yili/datasets/cinic/train', transform=transform),
+            datasets.ImageFolder(root='./c01yili/datasets/cinic/test', transform=transform),
+            datasets.ImageFolder(root='./c01yili/datasets/cinic/valid', transform=transform)]))
+        self.index = get_split_indices('cinic10', mode, train)
+        self.dataset = Subset(base_dataset, self.index)
 
     def __getitem__(self, idx):
         return self.dataset[idx][0], self.dataset[idx][1], self.index[idx]
@@ -388,55 +493,12 @@ class SUBCIFAR10(data.Dataset):
 
         self.normalized = transforms.Compose([transforms.ToTensor(), normalize])
 
-        self.aug_trainset =  datasets.CIFAR10(root='./c01yili/datasets/CIFAR10', train=True, download=True, transform=self.augmented)
-        self.aug_testset =  datasets.CIFAR10(root='./c01yili/datasets/CIFAR10', train=False, download=True, transform=self.augmented)
-        self.trainset =  datasets.CIFAR10(root='./c01yili/datasets/CIFAR10', train=True, download=True, transform=self.normalized)
-        self.testset =  datasets.CIFAR10(root='./c01yili/datasets/CIFAR10', train=False, download=True, transform=self.normalized)
-
-        self.aug_dataset = ConcatDataset([self.aug_trainset, self.aug_testset])
-        self.dataset = ConcatDataset([self.trainset, self.testset])
-        
-        self.aug_target_trainset, self.aug_target_testset, self.aug_shadow_trainset, self.aug_shadow_testset, self.aug_distill_trainset = dataset_split(self.aug_dataset, [10000, 10000, 10000, 10000, 20000])
-        self.aug_distill_testset = self.aug_shadow_testset
-        self.target_trainset, self.target_testset, self.shadow_trainset, self.shadow_testset, self.distill_trainset = dataset_split(self.dataset, [10000, 10000, 10000, 10000, 20000])
-        self.distill_testset = self.shadow_testset
-
-        if mode == 'target':
-            if aug:
-                if train:
-                    self.dataset = self.aug_target_trainset
-                else:
-                    self.dataset = self.aug_target_testset
-            else:
-                if train:
-                    self.dataset = self.target_trainset
-                else:
-                    self.dataset = self.target_testset
-        elif mode == 'shadow':
-            if aug:
-                if train:
-                    self.dataset = self.aug_shadow_trainset
-                else:
-                    self.dataset = self.aug_shadow_testset
-            else:
-                if train:
-                    self.dataset = self.shadow_trainset
-                else:
-                    self.dataset = self.shadow_testset
-        elif 'distill' in mode:
-            if aug:
-                if train:
-                    self.dataset = self.aug_distill_trainset
-                else:
-                    self.dataset = self.aug_distill_testset
-            else:
-                if train:
-                    self.dataset = self.distill_trainset
-                else:
-                    self.dataset = self.distill_testset
-
-        self.index = range(int(len(self.dataset)))
-
+        transform = self.augmented if aug else self.normalized
+        base_dataset = get_base_dataset('cifar10', aug, lambda: ConcatDataset([
+            datasets.CIFAR10(root='./c01yili/datasets/CIFAR10', train=True, download=True, transform=transform),
+            datasets.CIFAR10(root='./c01yili/datasets/CIFAR10', train=False, download=True, transform=transform)]))
+        self.index = get_split_indices('cifar10', mode, train)
+        self.dataset = Subset(base_dataset, self.index)
 
     def __getitem__(self, idx):
         return self.dataset[idx][0], self.dataset[idx][1], self.index[idx]
@@ -445,13 +507,16 @@ class SUBCIFAR10(data.Dataset):
         return len(self.index)
 
 class CIFAR10:
-    def __init__(self, mode, aug, batch_size=128, add_trigger=False):
+    def __init__(self, mode, aug, batch_size=128, add_trigger=False, cache=False):
         self.batch_size = batch_size
         self.img_size = 32
         self.num_classes = 10
         self.port_num = 3
         
-        if aug:
+        if cache:
+            set_cached_loaders(self, 'cifar10', mode, aug, batch_size, datasets.CIFAR10, './c01yili/datasets/CIFAR10',
+                               [0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        elif aug:
             if mode == 'target':
                 self.aug_target_trainset = SUBCIFAR10(mode, aug, True)
                 self.aug_target_train_loader = torch.utils.data.DataLoader(self.aug_target_trainset, batch_size=batch_size, shuffle=True, num_workers=2)
@@ -497,54 +562,12 @@ class SUBCIFAR100(data.Dataset):
         self.augmented = transforms.Compose([transforms.RandomHorizontalFlip(), transforms.RandomCrop(32, padding=4),transforms.ToTensor(), normalize])
         self.normalized = transforms.Compose([transforms.ToTensor(), normalize])
 
-        self.aug_trainset =  datasets.CIFAR100(root='./c01yili/datasets/CIFAR100', train=True, download=True, transform=self.augmented)
-        self.aug_testset =  datasets.CIFAR100(root='./c01yili/datasets/CIFAR100', train=False, download=True, transform=self.augmented)
-        self.trainset =  datasets.CIFAR100(root='./c01yili/datasets/CIFAR100', train=True, download=True, transform=self.normalized)
-        self.testset =  datasets.CIFAR100(root='./c01yili/datasets/CIFAR100', train=False, download=True, transform=self.normalized)
-
-        self.aug_dataset = ConcatDataset([self.aug_trainset, self.aug_testset])
-        self.dataset = ConcatDataset([self.trainset, self.testset])
-        
-        self.aug_target_trainset, self.aug_target_testset, self.aug_shadow_trainset, self.aug_shadow_testset, self.aug_distill_trainset = dataset_split(self.aug_dataset, [10000, 10000, 10000, 10000, 20000])
-        self.aug_distill_testset = self.aug_shadow_testset
-        self.target_trainset, self.target_testset, self.shadow_trainset, self.shadow_testset, self.distill_trainset = dataset_split(self.dataset, [10000, 10000, 10000, 10000, 20000])
-        self.distill_testset = self.shadow_testset
-
-        if mode == 'target':
-            if aug:
-                if train:
-                    self.dataset = self.aug_target_trainset
-                else:
-                    self.dataset = self.aug_target_testset
-            else:
-                if train:
-                    self.dataset = self.target_trainset
-                else:
-                    self.dataset = self.target_testset
-        elif mode == 'shadow':
-            if aug:
-                if train:
-                    self.dataset = self.aug_shadow_trainset
-                else:
-                    self.dataset = self.aug_shadow_testset
-            else:
-                if train:
-                    self.dataset = self.shadow_trainset
-                else:
-                    self.dataset = self.shadow_testset
-        elif 'distill' in mode:
-            if aug:
-                if train:
-                    self.dataset = self.aug_distill_trainset
-                else:
-                    self.dataset = self.aug_distill_testset
-            else:
-                if train:
-                    self.dataset = self.distill_trainset
-                else:
-                    self.dataset = self.distill_testset
-
-        self.index = range(int(len(self.dataset)))
+        transform = self.augmented if aug else self.normalized
+        base_dataset = get_base_dataset('cifar100', aug, lambda: ConcatDataset([
+            datasets.CIFAR100(root='./c01yili/datasets/CIFAR100', train=True, download=True, transform=transform),
+            datasets.CIFAR100(root='./c01yili/datasets/CIFAR100', train=False, download=True, transform=transform)]))
+        self.index = get_split_indices('cifar100', mode, train)
+        self.dataset = Subset(base_dataset, self.index)
 
     def __getitem__(self, idx):
         return self.dataset[idx][0], self.dataset[idx][1], self.index[idx]
@@ -553,12 +576,15 @@ class SUBCIFAR100(data.Dataset):
         return len(self.index)
 
 class CIFAR100:
-    def __init__(self, mode, aug, batch_size=128):
+    def __init__(self, mode, aug, batch_size=128, cache=False):
         self.batch_size = batch_size
         self.img_size = 32
         self.num_classes = 100
         self.port_num = 3
-        if aug:
+        if cache:
+            set_cached_loaders(self, 'cifar100', mode, aug, batch_size, datasets.CIFAR100, './c01yili/datasets/CIFAR100',
+                               [0.507, 0.487, 0.441], [0.267, 0.256, 0.276])
+        elif aug:
             if mode == 'target':
                 self.aug_target_trainset = SUBCIFAR100(mode, aug, True)
                 self.aug_target_train_loader = torch.utils.data.DataLoader(self.aug_target_trainset, batch_size=batch_size, shuffle=True, num_workers=1)
@@ -3,22 +3,70 @@ import argparse
 import utils
 import normal
 import MIA
+import artifacts
 
 def train_networks(args):
     device = utils.get_pytorch_device()
     utils.create_path('./outputs')
+    utils.set_logger('outputs/train_models1'.format(args.seed))
+
+    if args.num_shadows > 1 and args.mode != 'target':
+        # K shadow teachers under networks/{s}/shadow, each distilled once into networks/{s}/distill_shadow, and K
+        # distill runs of the single target under networks/{s}/distill_target, read back by the trajectory extraction
+        for seed in range(args.num_shadows):
+            utils.set_random_seeds(seed)
+            print('Training {} seed {}/{}'.format(args.mode, seed + 1, args.num_shadows))
+            if 'distill' in args.mode:
+                train_distill_seed(args, seed, device)
+            else:
+                train_model_seed(args, seed, device)
+        return
+
     if 'distill' in args.mode:
-        model_path_tar = 'networks/{}/{}'.format(0, args.mode.split('_')[-1])
-        utils.create_path(model_path_tar)
-        model_path_dis = 'networks/{}/{}'.format(args.seed, args.mode)
-        utils.create_path(model_path_dis)
+        train_distill_seed(args, args.seed, device)
+    elif args.is_detected and args.mode == 'target':
+        withdraw_target(args, device)
     else:
-        model_path_tar = 'networks/{}/{}'.format(args.seed, args.mode)
-        utils.create_path(model_path_tar)
-        model_path_dis = None
+        train_model_seed(args, args.seed, device)
 
-    utils.set_logger('outputs/train_models1'.format(args.seed))
+def train_model_seed(args, seed, device):
+    if args.artifact_store and artifacts.lookup(args, 'model', args.mode, seed) is not None:
+        print('Reusing {} model {}'.format(args.mode, artifacts.get_path(args, 'model', args.mode, seed)))
+        return
+    model_path_tar = artifacts.get_path(args, 'model', args.mode, seed)
+    utils.create_path(model_path_tar)
+    normal.train_models(args, model_path_tar, None, device)
+    artifacts.commit(args, 'model', args.mode, seed)
+
+def train_distill_seed(args, seed, device):
+    if args.artifact_store and artifacts.lookup(args, 'distill', args.mode, seed) is not None:
+        print('Reusing {} model {}'.format(args.mode, artifacts.get_path(args, 'distill', args.mode, seed)))
+        return
+    teacher_kind, teacher_mode, teacher_seed = artifacts.get_teacher(args, args.mode, seed)
+    model_path_tar = artifacts.lookup(args, teacher_kind, teacher_mode, teacher_seed)
+    if model_path_tar is None:
+        command = '--mode target --is_detected 1' if teacher_kind == 'withdrawal' else '--mode ' + teacher_mode
+        raise FileNotFoundError('No {} teacher of seed {} trained with these arguments, train it with {} first'.format(teacher_mode, teacher_seed, command))
+    model_path_dis = artifacts.get_path(args, 'distill', args.mode, seed)
+    utils.create_path(model_path_dis)
     normal.train_models(args, model_path_tar, model_path_dis, device)
+    artifacts.commit(args, 'distill', args.mode, seed)
+
+def withdraw_target(args, device):
+    if args.artifact_store and artifacts.lookup(args, 'withdrawal', 'target_withdrawn', args.seed) is not None:
+        print('Reusing withdrawn target model {}'.format(artifacts.get_path(args, 'withdrawal', 'target_withdrawn', args.seed)))
+        return
+    model_name = MIA.get_model_name(args.data, args.model)
+    model_path_tar = artifacts.get_path(args, 'model', 'target', args.seed)
+    if not os.path.exists('{}/{}/parameters_{}'.format(model_path_tar, model_name, args.epochs)):
+        # the withdrawal updates the trained target, it is only trained here if it does not exist yet
+        utils.create_path(model_path_tar)
+        normal.train_models(args, model_path_tar, None, device)
+        artifacts.commit(args, 'model', 'target', args.seed)
+    model_path_wd = artifacts.get_path(args, 'withdrawal', 'target_withdrawn', args.seed)
+    utils.create_path(model_path_wd)
+    normal.withdraw(args, model_path_tar, model_path_wd, model_name, device)
+    artifacts.commit(args, 'withdrawal', 'target_withdrawn', args.seed)
 
 def membership_inference_attack(args):
     print(f'--------------{args.mia_type}-------------')
@@ -26,26 +74,73 @@ def membership_inference_attack(args):
     device = utils.get_pytorch_device()
 
     if args.mia_type == 'build-dataset':
-        models_path = 'networks/{}'.format(0)
-        MIA.build_trajectory_membership_dataset(args, models_path, device)
+        if args.artifact_store and artifacts.lookup(args, 'trajectory', args.mode) is not None:
+            print('Reusing {} trajectory dataset {}'.format(args.mode, artifacts.get_path(args, 'trajectory', args.mode)))
+        else:
+            MIA.build_trajectory_membership_dataset(args, device)
+            artifacts.commit(args, 'trajectory', args.mode)
 
     if args.mia_type == 'black-box':
-        trained_models_path = 'networks/{}'.format(args.seed)
-        MIA.trajectory_black_box_membership_inference_attack(args, trained_models_path, device)
+        if args.artifact_store and artifacts.lookup(args, 'attack', seed=args.seed) is not None:
+            print('Reusing attack model {}'.format(artifacts.get_path(args, 'attack', seed=args.seed)))
+        else:
+            MIA.trajectory_black_box_membership_inference_attack(args, device)
+            artifacts.commit(args, 'attack', seed=args.seed)
 
-if __name__ == '__main__':
+    if args.mia_type == 'black-box-sweep':
+        MIA.attack_hyperparameter_sweep(args, device)
+
+    if args.mia_type == 'withdrawal':
+        MIA.withdrawal_membership_inference_attack(args, device)
+
+def get_parser():
     parser = argparse.ArgumentParser(description='TrajectoryMIA')
     parser.add_argument('--action', type=int, default=0, help=[0, 1])
     parser.add_argument('--seed', type=int, default=0)
-    parser.add_argument('--mode', type=str, default='target', help=['target', 'shadow', 'distill_target', 'distill_shadow'])
+    parser.add_argument('--mode', type=str, default='target', help=['target', 'shadow', 'distill_target', 'distill_shadow', 'distill_target_withdrawn'])
     parser.add_argument('--model', type=str, default='resnet', help=['resnet', 'mobilenet', 'vgg', 'wideresnet','lenet','rnn','rl'])
     parser.add_argument('--data', type=str, default='cifar100', help=['cinic10', 'cifar10', 'cifar100', 'gtsrb','mnist'])
     parser.add_argument('--epochs', type=int, default=100)
     parser.add_argument('--model_distill', type=str, default='resnet', help=['resnet', 'mobilenet', 'vgg', 'wideresnet','lenet','rnn','rl'])
     parser.add_argument('--epochs_distill', type=int, default=100)
-    parser.add_argument('--mia_type', type=str, help=['build-dataset', 'black-box'])
+    parser.add_argument('--mia_type', type=str, help=['build-dataset', 'black-box', 'black-box-sweep', 'withdrawal'])
     parser.add_argument('--port_num', type=int, default=3)
-    
+    parser.add_argument('--tensor_cache', type=int, default=0, help='serve cifar10/cifar100/mnist splits from a decoded uint8 cache with batched augmentation')
+    parser.add_argument('--eval_every', type=int, default=1, help='run the held-out evaluation every K epochs, the last epoch is always evaluated')
+    parser.add_argument('--eval_subsample', type=int, default=0, help='evaluate on a fixed subsample of this many held-out samples, 0 uses the whole split')
+    parser.add_argument('--teacher_cache', type=int, default=0, help='distill against teacher logits cached once on the non-augmented distill set')
+    parser.add_argument('--trajectory_order', type=str, default='batch', help=['batch', 'epoch'])
+    parser.add_argument('--num_shadows', type=int, default=1, help='shadow teachers under networks/{seed}/shadow, each distilled once, and distill runs of the target, stored under networks/{seed}/distill_{mode}')
+    parser.add_argument('--trajectory_agg', type=str, default='mean', help=['mean', 'sum', 'stack'])
+    parser.add_argument('--trajectory_workers', type=int, default=1, help='processes extracting distill seeds in parallel with --trajectory_order epoch')
+    parser.add_argument('--precision', type=str, default='fp32', help=['fp32', 'bf16'])
+    parser.add_argument('--channels_last', type=int, default=0, help='train vgg/mobilenet/resnet/wideresnet with channels-last activations')
+    parser.add_argument('--compile_inference', type=int, default=0, help='run evaluation and trajectory forwards through torch.compile, compiled once per architecture')
+    parser.add_argument('--fold_bn', type=int, default=1, help='score trajectories with copies of the networks whose BatchNorm layers are folded into the convolutions')
+    parser.add_argument('--attack_batch_size', type=int, default=128, help='minibatch size of the attack MLP training')
+    parser.add_argument('--tpr_fprs', type=str, default='0.001', help='comma separated FPRs at which the attack TPR is reported')
+    parser.add_argument('--roc_bins', type=int, default=0, help='compute the attack ROC from score histograms with this many bins, 0 sorts the exact scores')
+    parser.add_argument('--sweep_lr', type=str, default='0.01', help='comma separated attack learning rates for --mia_type black-box-sweep')
+    parser.add_argument('--sweep_epochs', type=str, default='100', help='comma separated attack epochs for --mia_type black-box-sweep')
+    parser.add_argument('--sweep_batch_size', type=str, default='128', help='comma separated attack batch sizes for --mia_type black-box-sweep')
+    parser.add_argument('--sweep_hidden', type=str, default='512-128-32', help='comma separated attack MLP hidden sizes, e.g. 512-128-32,256-64')
+    parser.add_argument('--sweep_workers', type=int, default=1, help='attack configurations trained in parallel processes')
+    parser.add_argument('--num_shards', type=int, default=1, help='SISA training of the target, one network per shard of the training split with averaged logits')
+    parser.add_argument('--num_slices', type=int, default=1, help='slices per shard, a checkpoint is kept at the end of each slice')
+    parser.add_argument('--shard_workers', type=int, default=1, help='shards trained in parallel processes')
+    parser.add_argument('--is_detected', type=int, default=0, help='with --mode target, withdraw --ratio of the target training split from the trained target, retraining only the affected shards of a SISA target')
+    parser.add_argument('--ratio', type=float, default=0.05, help='fraction of the target training split that is withdrawn')
+    parser.add_argument('--withdraw_epochs', type=int, default=5, help='fine-tuning epochs on the retained samples after a withdrawal')
+    parser.add_argument('--withdraw_lr', type=float, default=0.01, help='initial learning rate of the withdrawal fine-tuning')
+    parser.add_argument('--checkpoint_store', type=int, default=0, help='save the per-epoch distill snapshots to a compact fp16/int8-delta store instead of one torch.save file each')
+    parser.add_argument('--keyframe_every', type=int, default=10, help='full fp16 snapshot every K epochs of --checkpoint_store, 1 stores no deltas')
+    parser.add_argument('--weight_bank', type=int, default=0, help='save the per-epoch distill snapshots as the rows of one memory-mapped weight_bank.npy')
+    parser.add_argument('--artifact_store', type=int, default=0, help='keep networks, trajectory datasets and attack models under networks/store/{kind}/{hash of their arguments}')
+    parser.add_argument('--max_resident_models', type=int, default=0, help='distill checkpoints kept in memory while building trajectories, 0 keeps all')
+    return parser
+
+if __name__ == '__main__':
+    parser = get_parser()
     args = parser.parse_args()
     utils.set_random_seeds(args.seed)
     print('random seed:{}'.format(args.seed))
@@ -2,22 +2,31 @@ import os
 import torch
 import time 
 import random
+import copy
+import concurrent.futures
 import numpy as np
 import pickle
 import utils
-from architectures import VGG, MobileNet, ResNet, WideResNet,LeNet,RNN,RL
+import checkpoints
+import dataset as DATA
+from architectures import VGG, MobileNet, ResNet, WideResNet,LeNet,RNN,RL,ShardEnsemble
 
 def train(args, model_path_tar, untrained_model_tar, model_path_dis = None, untrained_model_dis = None, device='cpu'):
     print('Training models...')
     
     if 'distill' in args.mode:
+        # the withdrawn target is the last checkpoint of its withdrawal, see withdraw
+        teacher_epoch = -1 if args.mode == 'distill_target_withdrawn' else args.epochs
         trained_model, model_params = load_model(args, model_path_dis, untrained_model_dis, epoch=0)
-        trained_model_tar, model_params_tar =  load_model(args, model_path_tar, untrained_model_tar, epoch=args.epochs)
+        trained_model_tar, model_params_tar =  load_model(args, model_path_tar, untrained_model_tar, epoch=teacher_epoch)
     else:
         trained_model, model_params = load_model(args, model_path_tar, untrained_model_tar, epoch=0)
     print(model_params)
+    utils.set_memory_format(args, trained_model, model_params)
+    if 'distill' in args.mode:
+        utils.set_memory_format(args, trained_model_tar, model_params_tar)
 
-    dataset = utils.get_dataset(model_params['task'], args.mode, aug=True)
+    dataset = utils.get_dataset(model_params['task'], args.mode, aug=True, cache=args.tensor_cache)
     learning_rate = model_params['learning_rate']
     momentum = model_params['momentum']
     weight_decay = model_params['weight_decay']
@@ -41,6 +50,7 @@ def train(args, model_path_tar, untrained_model_tar, model_path_dis = None, untr
     model_params['test_top1_acc'] = metrics['test_top1_acc']
     model_params['train_top5_acc'] = metrics['train_top5_acc']
     model_params['test_top5_acc'] = metrics['test_top5_acc']
+    model_params['test_epochs'] = metrics['test_epochs']
     model_params['epoch_times'] = metrics['epoch_times']
     model_params['lrs'] = metrics['lrs']
     total_training_time = sum(model_params['epoch_times'])
@@ -83,11 +93,201 @@ def train_models(args, model_path_tar, model_path_dis, device='cpu'):
         elif args.model == 'rl':
             cnn_dis = create_rl(model_path_dis, args)
         train(args, model_path_tar, cnn_tar, model_path_dis, cnn_dis, device = device)
+    elif args.mode == 'target' and args.num_shards > 1:
+        train_sharded(args, model_path_tar, cnn_tar, device=device)
     else:
         train(args, model_path_tar, cnn_tar, device=device)
 
+def get_withdrawn_indices(num_samples, ratio, seed=0):
+    # positions in the target training split, the same for every run with this ratio and seed
+    if not 0 < ratio < 1:
+        raise ValueError('--ratio must be between 0 and 1, got {:g}'.format(ratio))
+    num_withdrawn = int(round(ratio * num_samples))
+    if num_withdrawn == 0:
+        raise ValueError('--ratio {:g} withdraws no sample of the {} in the target training split'.format(ratio, num_samples))
+    permutation = np.random.RandomState(seed).permutation(num_samples)
+    return np.sort(permutation[:num_withdrawn])
+
+def withdraw(args, model_path_tar, model_path_wd, model_name, device='cpu'):
+    """Removes a --ratio fraction of the target training split and updates the trained target without retraining it.
+
+    The target checkpoint of the last epoch is fine-tuned for --withdraw_epochs epochs on the retained samples only,
+    with a cosine schedule starting at --withdraw_lr. The updated model is saved as the last checkpoint of
+    model_path_wd, next to withdrawn_indices.npy with the split positions of the removed samples.
+    """
+    print('Withdrawing a {:g} fraction of the target training split...'.format(args.ratio))
+    if load_params(model_path_tar, model_name, epoch=args.epochs).get('num_shards', 1) > 1:
+        return withdraw_sharded(args, model_path_tar, model_path_wd, model_name, device)
+    trained_model, model_params = load_model(args, model_path_tar, model_name, epoch=args.epochs)
+    utils.set_memory_format(args, trained_model, model_params)
+
+    dataset = utils.get_dataset(model_params['task'], 'target', aug=True, cache=args.tensor_cache)
+    num_samples = len(dataset.aug_target_train_loader.dataset)
+    withdrawn = get_withdrawn_indices(num_samples, args.ratio, args.seed)
+    retained = np.setdiff1d(np.arange(num_samples), withdrawn)
+    for loader_name in ['aug_target_train_loader', 'target_train_loader']:
+        if hasattr(dataset, loader_name):
+            setattr(dataset, loader_name, DATA.subset_loader(getattr(dataset, loader_name), retained))
+    print('Withdrawn: {} samples, retained: {} samples'.format(len(withdrawn), len(retained)))
+
+    optimizer = torch.optim.SGD(filter(lambda p: p.requires_grad, trained_model.parameters()), lr=args.withdraw_lr,
+                                momentum=model_params['momentum'], weight_decay=model_params['weight_decay'])
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, args.withdraw_epochs)
+    model_params['withdrawn_ratio'] = args.ratio
+    model_params['withdraw_epochs'] = args.withdraw_epochs
+    model_params['withdraw_lr'] = args.withdraw_lr
+
+    trained_model.to(device)
+    trained_model.train_func(args, trained_model, dataset, args.withdraw_epochs, optimizer, scheduler, model_params, model_path_wd, model_name, device=device)
+    save_model(trained_model, model_params, model_path_wd, model_name, epoch=-1)
+    np.save(model_path_wd + '/' + model_name + '/withdrawn_indices.npy', withdrawn)
+
+def get_shard_assignment(num_samples, num_shards, num_slices):
+    """Shard (row 0) and slice (row 1) of every position of the target training split.
+
+    dataset_split already shuffled the split, so shards and slices are contiguous runs of positions.
+    """
+    assignment = np.zeros((2, num_samples), dtype=np.int64)
+    for shard, shard_positions in enumerate(np.array_split(np.arange(num_samples), num_shards)):
+        assignment[0, shard_positions] = shard
+        for slice_idx, slice_positions in enumerate(np.array_split(shard_positions, num_slices)):
+            assignment[1, slice_positions] = slice_idx
+    return assignment
+
+def get_slice_epochs(epochs, num_slices):
+    # --epochs spread over the slices, the first slices get the remainder
+    return [max(1, epochs // num_slices + (1 if slice_idx < epochs % num_slices else 0)) for slice_idx in range(num_slices)]
+
+def get_shard_name(model_name, shard):
+    return '{}/shard_{}'.format(model_name, shard)
+
+def train_shard(args, shard, assignment, model_path_start, model_path, model_name, start_slice=0, device='cpu'):
+    """Trains the slices start_slice.. of one shard, slice r on the shard samples of slices 0..r.
+
+    Starts from the untrained network of model_path_start when start_slice is 0, otherwise from the checkpoint
+    saved there at the end of slice start_slice - 1. Every slice gets a fresh SGD with a cosine schedule and its
+    last epoch is saved as checkpoint r + 1 of model_path/model_name/shard_{shard}.
+    """
+    shard_name = get_shard_name(model_name, shard)
+    if start_slice == 0:
+        model, model_params = load_model(args, model_path_start, model_name, epoch=0)
+    else:
+        model, model_params = load_model(args, model_path_start, shard_name, epoch=start_slice)
+    utils.set_memory_format(args, model, model_params)
+    model.to(device)
+
+    dataset = utils.get_dataset(model_params['task'], 'target', aug=True, cache=args.tensor_cache)
+    loaders = {name: getattr(dataset, name) for name in ['aug_target_train_loader', 'target_train_loader'] if hasattr(dataset, name)}
+    slice_epochs = get_slice_epochs(args.epochs, args.num_slices)
+    for slice_idx in range(start_slice, args.num_slices):
+        positions = np.flatnonzero((assignment[0] == shard) & (assignment[1] <= slice_idx))
+        print('Shard {} slice {}/{}: {} samples'.format(shard, slice_idx + 1, args.num_slices, len(positions)))
+        if len(positions) > 0:
+            for name, loader in loaders.items():
+                setattr(dataset, name, DATA.subset_loader(loader, positions))
+            optimizer = torch.optim.SGD(filter(lambda p: p.requires_grad, model.parameters()), lr=model_params['learning_rate'],
+                                        momentum=model_params['momentum'], weight_decay=model_params['weight_decay'])
+            scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, slice_epochs[slice_idx])
+            model.train_func(args, model, dataset, slice_epochs[slice_idx], optimizer, scheduler, model_params, model_path, shard_name, device=device)
+        save_model(model, model_params, model_path, shard_name, epoch=slice_idx + 1)
+
+def shard_worker(args, shard, assignment, model_path_start, model_path, model_name, start_slice, num_threads):
+    torch.set_num_threads(num_threads)
+    utils.set_random_seeds(args.seed + shard)
+    train_shard(args, shard, assignment, model_path_start, model_path, model_name, start_slice, utils.get_pytorch_device())
+
+def train_shards(args, start_slices, assignment, model_path_start, model_path, model_name, device='cpu'):
+    # start_slices maps each shard to (re)train to its first slice, the shards run in --shard_workers processes
+    if args.shard_workers > 1 and len(start_slices) > 1:
+        num_threads = max(1, (os.cpu_count() or 1) // args.shard_workers)
+        context = torch.multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.shard_workers, mp_context=context) as executor:
+            futures = [executor.submit(shard_worker, args, shard, assignment, model_path_start, model_path, model_name, start_slice, num_threads)
+                       for shard, start_slice in start_slices.items()]
+            for future in futures:
+                future.result()
+    else:
+        for shard, start_slice in start_slices.items():
+            utils.set_random_seeds(args.seed + shard)
+            train_shard(args, shard, assignment, model_path_start, model_path, model_name, start_slice, device)
+
+def save_shard_ensemble(args, shard_paths, model_path, model_name, epoch):
+    # the final shard checkpoints packed into one ShardEnsemble checkpoint that load_model reads like any other network
+    shards = []
+    shard_accuracies = []
+    for shard, shard_path in enumerate(shard_paths):
+        model, shard_params = load_model(args, shard_path, get_shard_name(model_name, shard), epoch=args.num_slices)
+        shards.append(model)
+        shard_accuracies.append(shard_params.get('test_top1_acc', [None])[-1])
+    model_params = load_params(shard_paths[0], get_shard_name(model_name, 0), epoch=args.num_slices)
+    for key in ['train_top1_acc', 'test_top1_acc', 'train_top5_acc', 'test_top5_acc', 'test_epochs', 'epoch_times', 'lrs', 'total_time']:
+        model_params.pop(key, None)
+    model_params['num_shards'] = args.num_shards
+    model_params['num_slices'] = args.num_slices
+    model_params['shard_test_top1_acc'] = shard_accuracies
+    save_model(ShardEnsemble(shards), model_params, model_path, model_name, epoch=epoch)
+
+def train_sharded(args, model_path_tar, model_name, device='cpu'):
+    """SISA training of the target, --num_shards networks on disjoint shards of the split, each in --num_slices slices.
+
+    The shard and slice of every split position are saved as sisa_assignment.npy, so that a withdrawal only
+    retrains the shards that held a withdrawn sample, from the end of the last slice before it.
+    """
+    print('Training {} shards of {} slices...'.format(args.num_shards, args.num_slices))
+    start_time = time.time()
+    task = load_params(model_path_tar, model_name, epoch=0)['task']
+    num_samples = len(utils.get_dataset(task, 'target', aug=True, cache=args.tensor_cache).aug_target_train_loader.dataset)
+    assignment = get_shard_assignment(num_samples, args.num_shards, args.num_slices)
+    np.save(model_path_tar + '/' + model_name + '/sisa_assignment.npy', assignment)
+
+    train_shards(args, {shard: 0 for shard in range(args.num_shards)}, assignment, model_path_tar, model_path_tar, model_name, device)
+    save_shard_ensemble(args, [model_path_tar] * args.num_shards, model_path_tar, model_name, epoch=args.epochs)
+    print('Sharded training took {:.1f} seconds...'.format(time.time() - start_time))
+
+def withdraw_sharded(args, model_path_tar, model_path_wd, model_name, device='cpu'):
+    """Withdraws --ratio of the split from a SISA target by retraining only the shards that held withdrawn samples.
+
+    Each affected shard restarts from its checkpoint at the end of the last slice without a withdrawn sample,
+    the other shards are reused as they are. The updated ensemble is saved as the last checkpoint of model_path_wd.
+    """
+    # the shards and slices of the trained target, whatever --num_shards and --num_slices say
+    model_params = load_params(model_path_tar, model_name, epoch=args.epochs)
+    args = copy.copy(args)
+    args.num_shards = model_params['num_shards']
+    args.num_slices = model_params['num_slices']
+    assignment = np.load(model_path_tar + '/' + model_name + '/sisa_assignment.npy')
+    withdrawn = get_withdrawn_indices(assignment.shape[1], args.ratio, args.seed)
+    print('Withdrawn: {} samples, retained: {} samples'.format(len(withdrawn), assignment.shape[1] - len(withdrawn)))
+    start_slices = {}
+    for shard, slice_idx in zip(assignment[0, withdrawn], assignment[1, withdrawn]):
+        start_slices[shard] = min(start_slices.get(shard, slice_idx), slice_idx)
+    start_slices = {int(shard): int(slice_idx) for shard, slice_idx in sorted(start_slices.items())}
+    print('Withdrawn: {} samples, retraining shards {} from slices {}'.format(len(withdrawn), list(start_slices), list(start_slices.values())))
+
+    assignment = assignment.copy()
+    assignment[:, withdrawn] = -1
+    utils.create_path(model_path_wd + '/' + model_name)
+    np.save(model_path_wd + '/' + model_name + '/sisa_assignment.npy', assignment)
+    np.save(model_path_wd + '/' + model_name + '/withdrawn_indices.npy', withdrawn)
+
+    train_shards(args, start_slices, assignment, model_path_tar, model_path_wd, model_name, device)
+    shard_paths = [model_path_wd if shard in start_slices else model_path_tar for shard in range(args.num_shards)]
+    save_shard_ensemble(args, shard_paths, model_path_wd, model_name, epoch=-1)
+
 def load_model(args, model_path, model_name, epoch=0):
-    model_params = load_params(model_path, model_name, epoch)
+    # distill snapshots written with --weight_bank or --checkpoint_store are read from the bank or store of the network
+    bank = checkpoints.get_bank(model_path + '/' + model_name) if epoch > 0 else None
+    store = checkpoints.get_store(model_path + '/' + model_name) if epoch > 0 else None
+    if bank is not None and epoch in bank:
+        store = None
+        model_params = bank.load_params()
+    elif store is not None and epoch in store:
+        bank = None
+        model_params = store.load_params()
+    else:
+        bank = None
+        store = None
+        model_params = load_params(model_path, model_name, epoch)
 
     architecture = 'empty' if 'architecture' not in model_params else model_params['architecture'] 
     network_type = model_params['network_type']
@@ -106,6 +306,9 @@ def load_model(args, model_path, model_name, epoch=0):
         model = RNN(args,model_params)
     elif 'rl' in network_type:
         model = RL(args,model_params)
+
+    if model_params.get('num_shards', 1) > 1:
+        model = ShardEnsemble([copy.deepcopy(model) for _ in range(model_params['num_shards'])])
         
     network_path = model_path + '/' + model_name
 
@@ -116,7 +319,11 @@ def load_model(args, model_path, model_name, epoch=0):
     else:
         load_path = network_path + '/' + str(epoch)
     
-    if torch.cuda.is_available():
+    if bank is not None:
+        bank.load_into(model, epoch)
+    elif store is not None:
+        model.load_state_dict(store.load_epoch(epoch), strict=False)
+    elif torch.cuda.is_available():
         model.load_state_dict(torch.load(load_path), strict=False)
     else:
         model.load_state_dict(torch.load(load_path, map_location=torch.device('cpu')), strict=False)
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import concurrent.futures
+import torch
+import utils
+import main
+import MIA
+import artifacts
+
+# stage name -> (upstream stages, action, mode, mia_type)
+STAGES = {
+    'target': ([], 0, 'target', None),
+    'shadow': ([], 0, 'shadow', None),
+    'distill_target': (['target'], 0, 'distill_target', None),
+    'distill_shadow': (['shadow'], 0, 'distill_shadow', None),
+    'build_target': (['target', 'distill_target'], 1, 'target', 'build-dataset'),
+    'build_shadow': (['shadow', 'distill_shadow'], 1, 'shadow', 'build-dataset'),
+    'attack': (['build_target', 'build_shadow'], 1, 'target', 'black-box'),
+}
+
+# arguments that only change how fast a stage runs, not what it writes
+RUNTIME_ARGS = ['action', 'mode', 'mia_type', 'workers', 'stage_threads', 'stages', 'force', 'max_resident_models', 'trajectory_workers', 'compile_inference', 'fold_bn', 'shard_workers', 'weight_bank']
+
+STAMP_PATH = 'outputs/pipeline'
+
+def get_stage_args(args, stage):
+    _, action, mode, mia_type = STAGES[stage]
+    stage_args = argparse.Namespace(**vars(args))
+    stage_args.action = action
+    stage_args.mode = mode
+    stage_args.mia_type = mia_type
+    return stage_args
+
+def get_stage_hash(args, stage, hashes):
+    config = {key: value for key, value in sorted(vars(args).items()) if key not in RUNTIME_ARGS}
+    config['stage'] = stage
+    config['upstream'] = [hashes[upstream] for upstream in STAGES[stage][0]]
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+def get_stage_outputs(args, stage):
+    model_name = MIA.get_model_name(args.data, args.model)
+    if stage in ['target', 'shadow']:
+        # one target, and one shadow teacher per --num_shadows seed
+        seeds = range(args.num_shadows) if args.num_shadows > 1 and stage == 'shadow' else [args.seed]
+        return ['{}/{}/parameters_{}'.format(artifacts.get_path(args, 'model', stage, s), model_name, args.epochs) for s in seeds]
+    elif stage in ['distill_target', 'distill_shadow']:
+        # distill runs are created from --model, see normal.train_models
+        seeds = range(args.num_shadows) if args.num_shadows > 1 else [args.seed]
+        return ['{}/{}/parameters_{}'.format(artifacts.get_path(args, 'distill', stage, s), model_name, args.epochs) for s in seeds]
+    elif stage == 'build_target':
+        return ['{}/{}/trajectory_test_data/manifest.json'.format(artifacts.get_path(args, 'trajectory', 'target'), model_name)]
+    elif stage == 'build_shadow':
+        return ['{}/{}/trajectory_train_data/manifest.json'.format(artifacts.get_path(args, 'trajectory', 'shadow'), model_name)]
+    elif stage == 'attack':
+        return ['{}/{}/trajectory.pkl'.format(artifacts.get_path(args, 'attack', seed=args.seed), model_name)]
+
+def is_stage_current(args, stage, stage_hash):
+    stamp_path = '{}/{}.json'.format(STAMP_PATH, stage)
+    if not os.path.exists(stamp_path) or not all(os.path.exists(path) for path in get_stage_outputs(args, stage)):
+        return False
+    with open(stamp_path, 'r') as f:
+        return json.load(f)['hash'] == stage_hash
+
+def run_stage(args, stage, num_threads):
+    torch.set_num_threads(num_threads)
+    utils.set_random_seeds(args.seed)
+    start_time = time.time()
+    stage_args = get_stage_args(args, stage)
+    if stage_args.action == 0:
+        main.train_networks(stage_args)
+    else:
+        main.membership_inference_attack(stage_args)
+    return time.time() - start_time
+
+def run_pipeline(args):
+    """Runs the target/shadow/distill/build/attack stages in dependency order.
+
+    Stages whose upstream stages are finished run concurrently in worker processes, each limited to
+    --stage_threads CPU threads. A stage is skipped when its outputs exist and its stamp in outputs/pipeline
+    matches the hash of its configuration and of its upstream stages.
+    """
+    utils.create_path(STAMP_PATH)
+    stages = [stage for stage in STAGES if args.stages is None or stage in args.stages.split(',')]
+    num_threads = args.stage_threads if args.stage_threads > 0 else max(1, (os.cpu_count() or 1) // args.workers)
+
+    hashes = {}
+    for stage in STAGES:
+        hashes[stage] = get_stage_hash(args, stage, hashes)
+
+    report = {}
+    done = set(stage for stage in STAGES if stage not in stages)
+    running = {}
+    pipeline_start = time.time()
+    context = torch.multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+        while len(done) < len(STAGES):
+            for stage in stages:
+                if stage in done or stage in running.values() or not all(upstream in done for upstream in STAGES[stage][0]):
+                    continue
+                if not args.force and is_stage_current(args, stage, hashes[stage]):
+                    print('Skipping {}: outputs are up to date'.format(stage))
+                    report[stage] = {'status': 'skipped', 'seconds': 0.0}
+                    done.add(stage)
+                    continue
+                print('Starting {} ...'.format(stage))
+                running[executor.submit(run_stage, args, stage, num_threads)] = stage
+
+            if not running:
+                continue
+            finished, _ = concurrent.futures.wait(list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                seconds = future.result()
+                print('Finished {} in {:.1f} seconds'.format(stage, seconds))
+                report[stage] = {'status': 'ran', 'seconds': seconds}
+                with open('{}/{}.json'.format(STAMP_PATH, stage), 'w') as f:
+                    json.dump({'hash': hashes[stage], 'seconds': seconds}, f)
+                done.add(stage)
+
+    report['total'] = {'status': 'wall-clock', 'seconds': time.time() - pipeline_start}
+    with open('outputs/pipeline_timing.json', 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print('{:<16} {:>8} {:>10}'.format('stage', 'status', 'seconds'))
+    for stage, entry in report.items():
+        print('{:<16} {:>8} {:>10.1f}'.format(stage, entry['status'], entry['seconds']))
+    return report
+
+if __name__ == '__main__':
+    parser = main.get_parser()
+    parser.description = 'TrajectoryMIA pipeline'
+    parser.add_argument('--workers', type=int, default=2, help='stages run concurrently')
+    parser.add_argument('--stage_threads', type=int, default=0, help='CPU threads per stage, 0 splits the cores evenly across workers')
+    parser.add_argument('--stages', type=str, default=None, help='comma separated subset of ' + ','.join(STAGES))
+    parser.add_argument('--force', type=int, default=0, help='rerun stages even if their outputs are up to date')
+
+    args = parser.parse_args()
+    run_pipeline(args)
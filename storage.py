@@ -0,0 +1,74 @@
+import os
+import json
+import numpy as np
+
+MANIFEST_NAME = 'manifest.json'
+
+def save_columns(path, columns, meta=None):
+    """Writes one .npy file per column plus a JSON manifest into the directory `path`.
+
+    The manifest is written last, so a directory without one is an interrupted write and is never read back.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    manifest = {'columns': {}, 'meta': meta if meta is not None else {}}
+    num_rows = None
+    for name, values in columns.items():
+        values = np.ascontiguousarray(values)
+        if num_rows is None:
+            num_rows = values.shape[0]
+        elif values.shape[0] != num_rows:
+            raise ValueError('Column {} has {} rows, expected {}'.format(name, values.shape[0], num_rows))
+        np.save(os.path.join(path, name + '.npy'), values)
+        manifest['columns'][name] = {'dtype': values.dtype.str, 'shape': list(values.shape)}
+    manifest['num_rows'] = num_rows if num_rows is not None else 0
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+def load_columns(path, mmap_mode='r', names=None):
+    """Returns ({name: array}, meta) for a directory written by save_columns, memory-mapping every column by default"""
+    with open(os.path.join(path, MANIFEST_NAME), 'r') as f:
+        manifest = json.load(f)
+
+    columns = {}
+    for name in manifest['columns']:
+        if names is not None and name not in names:
+            continue
+        columns[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+    return columns, manifest['meta']
+
+def is_column_store(path):
+    return os.path.isfile(os.path.join(path, MANIFEST_NAME))
+
+def convert_pickled_dataset(npy_path, path=None):
+    """Converts a dict saved with np.save (e.g. an old trajectory_*_data.npy) into the columnar layout.
+
+    Array entries become columns and scalar entries such as `nb_classes` go to the manifest's meta.
+    """
+    if path is None:
+        path = npy_path[:-len('.npy')] if npy_path.endswith('.npy') else npy_path
+    data = np.load(npy_path, allow_pickle=True).item()
+
+    columns = {}
+    meta = {}
+    for name, values in data.items():
+        if isinstance(values, np.ndarray) and values.ndim > 0:
+            columns[name] = values
+        else:
+            meta[name] = values.item() if isinstance(values, np.generic) else values
+    save_columns(path, columns, meta)
+    return path
+
+def load_trajectory_dataset(path, mmap_mode='r'):
+    """Loads a trajectory dataset directory, converting a legacy pickled `path`.npy the first time it is seen"""
+    if not is_column_store(path):
+        if not os.path.exists(path + '.npy'):
+            raise FileNotFoundError('No trajectory dataset at {}'.format(path))
+        print('Converting pickled trajectory dataset {}.npy ...'.format(path))
+        convert_pickled_dataset(path + '.npy', path)
+    return load_columns(path, mmap_mode)
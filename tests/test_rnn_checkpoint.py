@@ -0,0 +1,16 @@
+import torch
+import main
+import normal
+
+def test_untrained_rnn_checkpoint_round_trip(tmp_path):
+    # the RNN layers are built in __init__, so the untrained checkpoint holds their weights and loads them back
+    args = main.get_parser().parse_args(['--model', 'rnn', '--data', 'cifar10'])
+    model_name = normal.create_rnn(str(tmp_path), args)
+    saved = torch.load(str(tmp_path / model_name / 'untrained'))
+    model, _ = normal.load_model(args, str(tmp_path), model_name, epoch=0)
+    loaded = model.state_dict()
+
+    assert any(name.startswith('rnn.') for name in saved)
+    assert sorted(saved) == sorted(loaded)
+    for name in saved:
+        assert torch.equal(saved[name], loaded[name])
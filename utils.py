@@ -4,10 +4,14 @@ import random
 import sys
 import time
 import os
+import copy
+import contextlib
 import dataset
+import checkpoints
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss
+from torch.utils.data import DataLoader
 from torch.optim import SGD, Adam
 from torch.optim.lr_scheduler import _LRScheduler, CosineAnnealingLR
 from bisect import bisect_right
@@ -84,10 +88,106 @@ def get_lr(optimizers):
 def get_loss_criterion():
     return CrossEntropyLoss()
 
+def get_sample_losses(logits, targets):
+    # one batched kernel and a single device-to-host copy instead of a cross_entropy call per sample
+    return F.cross_entropy(logits.detach(), targets, reduction='none').cpu().numpy()
+
+class ColumnBuffer(object):
+    """Named numpy columns that batches are written into in place, growing geometrically past the initial capacity"""
+    def __init__(self, capacity=0):
+        self.capacity = int(capacity)
+        self.size = 0
+        self.columns = {}
+
+    def append(self, **batch):
+        batch = {name: np.asarray(values) for name, values in batch.items()}
+        num_rows = len(next(iter(batch.values())))
+        if self.size + num_rows > self.capacity:
+            self._grow(self.size + num_rows)
+
+        for name, values in batch.items():
+            if name not in self.columns:
+                self.columns[name] = np.empty((self.capacity,) + values.shape[1:], dtype=values.dtype)
+            self.columns[name][self.size:self.size+num_rows] = values
+        self.size += num_rows
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, 2 * self.capacity)
+        for name, column in self.columns.items():
+            grown = np.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+        self.capacity = capacity
+
+    def __getitem__(self, name):
+        return self.columns[name][:self.size]
+
+    def __len__(self):
+        return self.size
+
 class Flatten(nn.Module):
     def forward(self, input):
         return input.view(input.size(0), -1)
 
+# convolution-only networks, their NHWC kernels are faster on CPU
+CHANNELS_LAST_NETWORKS = ['vgg', 'mobilenet', 'resnet56', 'wideresnet']
+
+def set_memory_format(args, model, model_params):
+    model.channels_last = bool(args.channels_last) and any(name in model_params['network_type'] for name in CHANNELS_LAST_NETWORKS)
+    if model.channels_last:
+        model.to(memory_format=torch.channels_last)
+    return model
+
+def to_model_format(model, x):
+    if getattr(model, 'channels_last', False) and x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+def get_autocast(precision='fp32', device='cpu'):
+    if precision == 'bf16':
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+class CompiledInference(nn.Module):
+    """Forward-only torch.compile wrapper around a network that falls back to eager execution if compilation fails"""
+    def __init__(self, model):
+        super(CompiledInference, self).__init__()
+        self.model = model
+        self.channels_last = getattr(model, 'channels_last', False)
+        self.compiled = torch.compile(model) if hasattr(torch, 'compile') else None
+        self.checked = False
+
+    def forward(self, x):
+        if self.compiled is None:
+            return self.model(x)
+        if self.checked:
+            return self.compiled(x)
+        try:
+            output = self.compiled(x)
+            self.checked = True
+            return output
+        except Exception as e:
+            print('Compiled inference is not available ({}: {}), running eagerly'.format(type(e).__name__, e))
+            self.compiled = None
+            return self.model(x)
+
+_compiled_models = {}
+
+def get_compiled_model(model, model_params, device='cpu'):
+    # one compiled network per architecture and task, the weights of every further checkpoint are copied into it
+    # so the traced graph is reused instead of compiling each snapshot again. Folded and unfolded copies of an
+    # architecture have different layers and get separate entries
+    key = (model_params['base_model'], getattr(model, 'folded', False), str(device))
+    if key not in _compiled_models:
+        # a private copy, the caller's network may be cached and must keep its own weights
+        _compiled_models[key] = CompiledInference(copy.deepcopy(model).to(device).eval())
+    else:
+        _compiled_models[key].model.load_state_dict(model.state_dict(), strict=True)
+    return _compiled_models[key]
+
+def get_eval_model(args, model):
+    return CompiledInference(model) if args.compile_inference else model
+
 def cnn_test(model, loader, device='cpu'):
     model.eval()
     top1 = dataset.AverageMeter()
@@ -95,7 +195,7 @@ def cnn_test(model, loader, device='cpu'):
 
     with torch.no_grad():
         for batch in loader:
-            b_x = batch[0].to(device)
+            b_x = to_model_format(model, batch[0].to(device))
             b_y = batch[1].to(device)
             output = model(b_x)
             prec1, prec5 = dataset.accuracy(output, b_y, topk=(1, 5))
@@ -108,19 +208,37 @@ def cnn_test(model, loader, device='cpu'):
     return top1_acc, top5_acc
 
 
-def cnn_training_step(model, optimizer, data, labels, device='cpu'):
-    b_x = data.to(device) 
+def cnn_training_step(model, optimizer, data, labels, device='cpu', precision='fp32'):
+    b_x = to_model_format(model, data.to(device))
     b_y = labels.to(device)  
-    output = model(b_x)         
-    criterion = get_loss_criterion()
-    loss = criterion(output, b_y) 
+    with get_autocast(precision, device):
+        output = model(b_x)         
+        criterion = get_loss_criterion()
+        loss = criterion(output, b_y) 
     optimizer.zero_grad()           
     loss.backward()                 
     optimizer.step() 
+    return dataset.accuracy(output.detach().float(), b_y, topk=(1, 5))
+
+def should_evaluate(args, epoch, epochs):
+    return epoch % args.eval_every == 0 or epoch == epochs
+
+def get_eval_loader(loader, num_samples):
+    # a fixed random subsample of the held-out split, so the per-epoch curve stays comparable across epochs
+    if num_samples <= 0 or num_samples >= len(loader.dataset):
+        return loader
+    indices = np.random.RandomState(0).permutation(len(loader.dataset))[:num_samples]
+    return DataLoader(torch.utils.data.Subset(loader.dataset, indices), batch_size=loader.batch_size, shuffle=False, num_workers=loader.num_workers)
+
+def update_train_meters(top1, top5, prec, batch_size):
+    prec1, prec5 = prec
+    top1.update(prec1[0], batch_size)
+    top5.update(prec5[0], batch_size)
 
 def cnn_train(args, model, data, epochs, optimizer, scheduler, model_params, model_path, trained_model_name, device='cpu'):
-    metrics = {'epoch_times':[], 'test_top1_acc':[], 'test_top5_acc':[], 'train_top1_acc':[], 'train_top5_acc':[], 'lrs':[]}
+    metrics = {'epoch_times':[], 'test_top1_acc':[], 'test_top5_acc':[], 'test_epochs':[], 'train_top1_acc':[], 'train_top5_acc':[], 'lrs':[]}
 
+    eval_model = get_eval_model(args, model)
     for epoch in range(1, epochs+1):
         
         cur_lr = get_lr(optimizer)
@@ -148,17 +266,22 @@ def cnn_train(args, model, data, epochs, optimizer, scheduler, model_params, mod
         model.train()
         print('Epoch: {}/{}'.format(epoch, epochs))
         print('Cur lr: {}'.format(cur_lr))
+        top1 = dataset.AverageMeter()
+        top5 = dataset.AverageMeter()
         for x, y, idx in train_loader:
-            cnn_training_step(model, optimizer, x, y, device)
+            prec = cnn_training_step(model, optimizer, x, y, device, args.precision)
+            update_train_meters(top1, top5, prec, x.size(0))
         end_time = time.time()
     
-        top1_test, top5_test = cnn_test(model, test_loader, device)
-        print('Top1 Test accuracy: {}'.format(top1_test))
-        print('Top5 Test accuracy: {}'.format(top5_test))
-        metrics['test_top1_acc'].append(top1_test)
-        metrics['test_top5_acc'].append(top5_test)
-
-        top1_train, top5_train = cnn_test(model, train_loader, device)
+        if should_evaluate(args, epoch, epochs):
+            top1_test, top5_test = cnn_test(eval_model, get_eval_loader(test_loader, args.eval_subsample), device)
+            print('Top1 Test accuracy: {}'.format(top1_test))
+            print('Top5 Test accuracy: {}'.format(top5_test))
+            metrics['test_top1_acc'].append(top1_test)
+            metrics['test_top5_acc'].append(top5_test)
+            metrics['test_epochs'].append(epoch)
+
+        top1_train, top5_train = top1.avg.data.cpu().numpy()[()], top5.avg.data.cpu().numpy()[()]
         print('Top1 Train accuracy: {}'.format(top1_train))
         print('Top5 Train accuracy: {}'.format(top5_train))
         metrics['train_top1_acc'].append(top1_train)
@@ -174,6 +297,7 @@ def cnn_train(args, model, data, epochs, optimizer, scheduler, model_params, mod
         model_params['test_top1_acc'] = metrics['test_top1_acc']
         model_params['train_top5_acc'] = metrics['train_top5_acc']
         model_params['test_top5_acc'] = metrics['test_top5_acc']
+        model_params['test_epochs'] = metrics['test_epochs']
         model_params['epoch_times'] = metrics['epoch_times']
         model_params['lrs'] = metrics['lrs']
         total_training_time = sum(model_params['epoch_times'])
@@ -182,19 +306,64 @@ def cnn_train(args, model, data, epochs, optimizer, scheduler, model_params, mod
 
     return metrics
 
-def cnn_training_step_dis(model, model_dis, optimizer, data, labels, device='cpu'):
-    b_x = data.to(device)   
+def cnn_training_step_dis(model, model_dis, optimizer, data, labels, device='cpu', teacher_logits=None, precision='fp32'):
+    b_x = to_model_format(model_dis, data.to(device))
     b_y_1 = labels.to(device)   
-    output = model_dis(b_x)            
-    b_y = model(b_x)
-    loss = nn.KLDivLoss(reduction='batchmean')(F.log_softmax(output, dim=1), F.softmax(b_y, dim=1))
+    with get_autocast(precision, device):
+        output = model_dis(b_x)            
+        if teacher_logits is not None:
+            b_y = teacher_logits.to(device).float()
+        else:
+            with torch.no_grad():
+                b_y = model(b_x)
+        loss = nn.KLDivLoss(reduction='batchmean')(F.log_softmax(output, dim=1), F.softmax(b_y, dim=1))
     optimizer.zero_grad()           
     loss.backward()                 
     optimizer.step() 
+    return dataset.accuracy(output.detach().float(), b_y_1, topk=(1, 5))
+
+def get_teacher_logits(args, model, model_params, model_path, trained_model_name, device='cpu', batch_size=512):
+    # soft labels of the frozen teacher for every distill train sample, one row per position in the split
+    clean_data = get_dataset(model_params['task'], args.mode, aug=False, batch_size=batch_size, cache=args.tensor_cache)
+    loader = DataLoader(clean_data.distill_trainset, batch_size=batch_size, shuffle=False)
+    create_path(model_path + '/' + trained_model_name)
+    cache_path = model_path + '/' + trained_model_name + '/teacher_logits.npy'
+    teacher_logits = None
+
+    model = model.to(device)
+    model.eval()
+    print('Caching teacher logits to {} ...'.format(cache_path))
+    with torch.no_grad():
+        for x, y, idx in loader:
+            output = model(to_model_format(model, x.to(device)))
+            if teacher_logits is None:
+                teacher_logits = np.lib.format.open_memmap(cache_path, mode='w+', dtype=np.float16, shape=(len(loader.dataset), output.shape[1]))
+            teacher_logits[dataset.get_positions(loader.dataset, idx.numpy())] = output.cpu().numpy().astype(np.float16)
+    teacher_logits.flush()
+
+    return np.load(cache_path, mmap_mode='r')
 
 def cnn_train_dis(args, model, model_dis, data, epochs, optimizer, scheduler, model_params, model_path, trained_model_name, device='cpu'):
-    metrics = {'epoch_times':[], 'test_top1_acc':[], 'test_top5_acc':[], 'train_top1_acc':[], 'train_top5_acc':[], 'lrs':[]}
+    metrics = {'epoch_times':[], 'test_top1_acc':[], 'test_top5_acc':[], 'test_epochs':[], 'train_top1_acc':[], 'train_top5_acc':[], 'lrs':[]}
+
+    teacher_logits = None
+    if args.teacher_cache:
+        teacher_logits = get_teacher_logits(args, model, model_params, model_path, trained_model_name, device)
 
+    store = None
+    if args.checkpoint_store:
+        store = checkpoints.CheckpointStore(model_path + '/' + trained_model_name, args.keyframe_every, reset=True)
+    else:
+        # load_model reads a store before the per-epoch files, one left by an earlier run would shadow this one
+        checkpoints.remove_store(model_path + '/' + trained_model_name)
+    bank = None
+    if args.weight_bank:
+        bank = checkpoints.WeightBank.create(model_path + '/' + trained_model_name, model_dis, epochs)
+    else:
+        # read before the store and the per-epoch files, like a leftover store
+        checkpoints.remove_bank(model_path + '/' + trained_model_name)
+
+    eval_model = get_eval_model(args, model_dis)
     for epoch in range(1, epochs+1):
         
         cur_lr = get_lr(optimizer)
@@ -215,17 +384,23 @@ def cnn_train_dis(args, model, model_dis, data, epochs, optimizer, scheduler, mo
         model.eval()
         print('Epoch: {}/{}'.format(epoch, epochs))
         print('Cur lr: {}'.format(cur_lr))
+        top1 = dataset.AverageMeter()
+        top5 = dataset.AverageMeter()
         for i, (x, y, idx)  in enumerate(train_loader):
-            cnn_training_step_dis(model, model_dis, optimizer, x, y, device)
+            batch_teacher_logits = None if teacher_logits is None else torch.from_numpy(teacher_logits[dataset.get_positions(train_loader.dataset, idx.numpy())])
+            prec = cnn_training_step_dis(model, model_dis, optimizer, x, y, device, batch_teacher_logits, args.precision)
+            update_train_meters(top1, top5, prec, x.size(0))
         end_time = time.time()
     
-        top1_test, top5_test = cnn_test(model_dis, test_loader, device)
-        print('Top1 Test accuracy: {}'.format(top1_test))
-        print('Top5 Test accuracy: {}'.format(top5_test))
-        metrics['test_top1_acc'].append(top1_test)
-        metrics['test_top5_acc'].append(top5_test)
-
-        top1_train, top5_train = cnn_test(model_dis, train_loader, device)
+        if should_evaluate(args, epoch, epochs):
+            top1_test, top5_test = cnn_test(eval_model, get_eval_loader(test_loader, args.eval_subsample), device)
+            print('Top1 Test accuracy: {}'.format(top1_test))
+            print('Top5 Test accuracy: {}'.format(top5_test))
+            metrics['test_top1_acc'].append(top1_test)
+            metrics['test_top5_acc'].append(top5_test)
+            metrics['test_epochs'].append(epoch)
+
+        top1_train, top5_train = top1.avg.data.cpu().numpy()[()], top5.avg.data.cpu().numpy()[()]
         print('Top1 Train accuracy: {}'.format(top1_train))
         print('Top5 Train accuracy: {}'.format(top5_train))
         metrics['train_top1_acc'].append(top1_train)
@@ -241,26 +416,35 @@ def cnn_train_dis(args, model, model_dis, data, epochs, optimizer, scheduler, mo
         model_params['test_top1_acc'] = metrics['test_top1_acc']
         model_params['train_top5_acc'] = metrics['train_top5_acc']
         model_params['test_top5_acc'] = metrics['test_top5_acc']
+        model_params['test_epochs'] = metrics['test_epochs']
         model_params['epoch_times'] = metrics['epoch_times']
         model_params['lrs'] = metrics['lrs']
         total_training_time = sum(model_params['epoch_times'])
         model_params['total_time'] = total_training_time
         print('Training took {} seconds...'.format(total_training_time))
-        save_model(model_dis, model_params, model_path, trained_model_name, epoch=epoch)
+        if bank is not None:
+            bank.write(epoch, model_dis, model_params)
+        if store is not None:
+            store.save_epoch(epoch, model_dis.state_dict(), model_params)
+        if bank is None and store is None:
+            save_model(model_dis, model_params, model_path, trained_model_name, epoch=epoch)
 
     return metrics
 
-def get_dataset(dataset, mode, aug=False, batch_size=512, add_trigger=False):
+def get_dataset(dataset, mode, aug=False, batch_size=512, add_trigger=False, cache=False):
+    start_time = time.time()
     if dataset == 'cifar10':
-        return load_cifar10(mode, aug, batch_size, add_trigger)
+        data = load_cifar10(mode, aug, batch_size, add_trigger, cache)
     elif dataset == 'gtsrb':
-        return load_gtsrb(mode, aug, batch_size, add_trigger)
+        data = load_gtsrb(mode, aug, batch_size, add_trigger)
     elif dataset == 'cinic10':
-        return load_cinic10(mode, aug, batch_size, add_trigger)
+        data = load_cinic10(mode, aug, batch_size, add_trigger)
     elif dataset == 'cifar100':
-        return load_cifar100(mode, aug, batch_size)
+        data = load_cifar100(mode, aug, batch_size, cache)
     elif dataset == 'mnist': 
-        return load_mnist(mode, aug, batch_size)
+        data = load_mnist(mode, aug, batch_size, cache)
+    print('Building {} {} loaders took {:.2f} seconds'.format(dataset, mode, time.time() - start_time))
+    return data
     
 def load_gtsrb(mode, aug, batch_size, add_trigger=False):
     gtsrb_data = dataset.GTSRB(mode, aug, batch_size=batch_size)
@@ -270,16 +454,16 @@ def load_cinic10(mode, aug, batch_size, add_trigger=False):
     cinic10_data = dataset.CINIC10(mode, aug, batch_size=batch_size, add_trigger=add_trigger)
     return cinic10_data
 
-def load_cifar10(mode, aug, batch_size, add_trigger=False):
-    cifar10_data = dataset.CIFAR10(mode, aug, batch_size=batch_size, add_trigger=add_trigger)
+def load_cifar10(mode, aug, batch_size, add_trigger=False, cache=False):
+    cifar10_data = dataset.CIFAR10(mode, aug, batch_size=batch_size, add_trigger=add_trigger, cache=cache)
     return cifar10_data
 
-def load_cifar100(mode, aug, batch_size):
-    cifar100_data = dataset.CIFAR100(mode, aug, batch_size=batch_size)
+def load_cifar100(mode, aug, batch_size, cache=False):
+    cifar100_data = dataset.CIFAR100(mode, aug, batch_size=batch_size, cache=cache)
     return cifar100_data
 
-def load_mnist(mode, aug, batch_size):
-    mnist_data = dataset.MNIST(mode, aug, batch_size=batch_size)
+def load_mnist(mode, aug, batch_size, cache=False):
+    mnist_data = dataset.MNIST(mode, aug, batch_size=batch_size, cache=cache)
     return mnist_data
 
 def get_full_optimizer(model, lr_params, args):